@@ -0,0 +1,347 @@
+import os
+import mmap
+import errno
+import fcntl
+import select
+import shutil
+import struct
+import tempfile
+import time
+import itertools
+import threading
+
+"""
+  Local publish/subscribe channels between processes on the same machine.
+
+  Each channel is a ring buffer in a memory-mapped file (in /dev/shm, i.e.
+  shared memory), written by publishers and read by any number of
+  subscribers without involving the supervisor or the server.  Subscribers
+  are woken by a byte written to their FIFO (in <channel>.subs/) when new
+  messages are published.
+
+  Layout of the file: a header (magic, slot size, number of slots, sequence
+  number of the next message) followed by the slots, each holding the
+  sequence number and length of its message and the message itself.
+  Subscribers detect when they fall more than the number of slots behind
+  (the lost messages are counted).
+"""
+
+_magic = "RSPBYCH1"
+_header = struct.Struct("<8sIIQ")
+_header_size = 64
+_seq_offset = 16
+_slot_header = struct.Struct("<QI")
+_invalid_seq = 2**64 - 1
+
+_channel_dir = None
+
+def set_channel_dir(path):
+    """
+    Set the directory of the channel files, this is called by the supervisor
+    before starting the child processes.
+
+    :param path: path to directory, created if it doesn't exist
+    :type path: str
+    """
+    global _channel_dir
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+    _channel_dir = path
+
+def create_channel_dir():
+    """
+    Create a new channel directory (in /dev/shm if available) for the current
+    process and use it, see :func:`set_channel_dir`
+
+    :returns: str - path of the directory
+    """
+    base = None
+    if os.path.isdir("/dev/shm"): base = "/dev/shm"
+    _remove_stale_dirs(base or tempfile.gettempdir())
+    path = tempfile.mkdtemp(prefix="rspby-{}-".format(os.getpid()), dir=base)
+    set_channel_dir(path)
+    return path
+
+def _remove_stale_dirs(base):
+    # Directories left behind by processes that are gone
+    for fn in os.listdir(base):
+        parts = fn.split("-")
+        if len(parts) != 3 or parts[0] != "rspby" or not parts[1].isdigit(): continue
+        try:
+            os.kill(int(parts[1]), 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                shutil.rmtree(os.path.join(base, fn), True)
+
+def remove_channel_dir():
+    """
+    Remove the channel directory with all channels
+    """
+    global _channel_dir
+    if _channel_dir is not None:
+        shutil.rmtree(_channel_dir, True)
+    _channel_dir = None
+
+def _get_channel_dir():
+    if _channel_dir is None: create_channel_dir()
+    return _channel_dir
+
+
+class LocalChannel(object):
+    """
+    A channel, see module description.  All processes opening the channel
+    with the same name must use the same slot_size and slots.
+
+    :param name: name of the channel
+    :type name: str
+    :param slot_size: maximum size (bytes) of one message
+    :type slot_size: int
+    :param slots: number of messages kept in the ring buffer
+    :type slots: int
+    :param fmt: struct format of the messages, used by
+                :meth:`publish_values` and :meth:`Subscriber.recv_values`
+    :type fmt: str
+    """
+    def __init__(self, name, slot_size=256, slots=1024, fmt=None):
+        if not name or not all(c.isalnum() or c in "._-" for c in name):
+            raise Exception("Invalid channel name: '{}'".format(name))
+        self.name = name
+        self.fmt = None
+        if fmt is not None:
+            self.fmt = struct.Struct(fmt)
+            slot_size = max(slot_size, self.fmt.size)
+        path = os.path.join(_get_channel_dir(), name)
+        self.sub_dir = path + ".subs"
+        try:
+            os.mkdir(self.sub_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                stride = (_slot_header.size + slot_size + 7) & ~7
+                os.ftruncate(fd, _header_size + stride*slots)
+                os.write(fd, _header.pack(_magic, slot_size, slots, 0))
+            else:
+                m, size, n, _ = _header.unpack(os.read(fd, _header.size))
+                if m != _magic or size != slot_size or n != slots:
+                    raise Exception("Channel '{}' exists with different size".format(name))
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, 0)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self.slot_size = slot_size
+        self.slots = slots
+        self._stride = (_slot_header.size + slot_size + 7) & ~7
+        self._sub_fds = {}
+        self._sub_mtime = None
+        # flock only excludes other processes, not other threads
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def _slot_offset(self, seq):
+        return _header_size + (seq % self.slots)*self._stride
+
+    def write_seq(self):
+        """
+        :returns: int - sequence number of the next message
+        """
+        return struct.unpack_from("<Q", self._map, _seq_offset)[0]
+
+    def publish(self, data):
+        """
+        Publish a message (str of at most slot_size bytes)
+        """
+        if len(data) > self.slot_size:
+            raise Exception("Message too large for channel '{}'".format(self.name))
+        m = self._map
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                seq = self.write_seq()
+                off = self._slot_offset(seq)
+                # Mark the slot as invalid while it is written
+                _slot_header.pack_into(m, off, _invalid_seq, 0)
+                start = off + _slot_header.size
+                m[start:start+len(data)] = data
+                _slot_header.pack_into(m, off, seq, len(data))
+                struct.pack_into("<Q", m, _seq_offset, seq + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.published += 1
+            self._notify()
+
+    def publish_values(self, *values):
+        """
+        Publish values packed with the format of the channel
+        """
+        self.publish(self.fmt.pack(*values))
+
+    def _notify(self):
+        try:
+            mtime = os.stat(self.sub_dir).st_mtime
+        except OSError:
+            return
+        if mtime != self._sub_mtime:
+            self._sub_mtime = mtime
+            self._refresh_subscribers()
+        for fn, fd in self._sub_fds.items():
+            try:
+                os.write(fd, "\0")
+            except OSError as e:
+                # A full FIFO means the subscriber is already notified
+                if e.errno == errno.EAGAIN: continue
+                self._drop_subscriber(fn)
+
+    def _refresh_subscribers(self):
+        names = set(os.listdir(self.sub_dir))
+        for fn in self._sub_fds.keys():
+            if fn not in names:
+                os.close(self._sub_fds.pop(fn))
+        for fn in names - set(self._sub_fds):
+            try:
+                self._sub_fds[fn] = os.open(os.path.join(self.sub_dir, fn),
+                                            os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # No reader, i.e. the subscriber is gone
+                if e.errno == errno.ENXIO:
+                    try:
+                        os.remove(os.path.join(self.sub_dir, fn))
+                    except OSError: pass
+
+    def _drop_subscriber(self, fn):
+        os.close(self._sub_fds.pop(fn))
+        try:
+            os.remove(os.path.join(self.sub_dir, fn))
+        except OSError: pass
+
+    def subscribe(self):
+        """
+        :returns: :class:`Subscriber` - receiving the messages published from now on
+        """
+        return Subscriber(self)
+
+    def close(self):
+        for fd in self._sub_fds.values(): os.close(fd)
+        self._sub_fds = {}
+        self._map.close()
+        os.close(self._fd)
+
+
+_sub_counter = itertools.count()
+
+class Subscriber(object):
+    """
+    Receives the messages of a :class:`LocalChannel`, created with
+    :meth:`LocalChannel.subscribe`.  The number of messages missed because
+    the subscriber fell behind by more than the number of slots is counted
+    in lost.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.lost = 0
+        self._fifo = os.path.join(channel.sub_dir,
+                                  "{}-{}".format(os.getpid(), next(_sub_counter)))
+        os.mkfifo(self._fifo, 0o600)
+        # Opened for writing as well, so that the FIFO never reports EOF
+        # (i.e. is always readable) after a publisher closed it
+        self._rfd = os.open(self._fifo, os.O_RDWR | os.O_NONBLOCK)
+        self._read_seq = channel.write_seq()
+
+    def fileno(self):
+        """
+        File descriptor readable when messages may be available, e.g. for select
+        """
+        return self._rfd
+
+    def _drain(self):
+        try:
+            while os.read(self._rfd, 4096): pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN: raise
+
+    def _read(self):
+        ch = self.channel
+        m = ch._map
+        while True:
+            write_seq = ch.write_seq()
+            if self._read_seq >= write_seq: return None
+            if write_seq - self._read_seq > ch.slots:
+                self.lost += write_seq - ch.slots - self._read_seq
+                self._read_seq = write_seq - ch.slots
+            off = ch._slot_offset(self._read_seq)
+            seq, length = _slot_header.unpack_from(m, off)
+            start = off + _slot_header.size
+            data = m[start:start+length]
+            # The slot may have been overwritten while it was copied
+            if (seq == self._read_seq and
+                _slot_header.unpack_from(m, off)[0] == seq):
+                self._read_seq += 1
+                return data
+            # Overwritten (or being overwritten) by a newer message
+            self.lost += 1
+            self._read_seq += 1
+
+    def recv(self, timeout=None):
+        """
+        Receive the next message
+
+        :param timeout: time (s) to wait, None waits forever, 0 doesn't wait
+        :type timeout: float
+        :returns: str - the message, None if there is none within timeout
+        """
+        end_time = None
+        if timeout is not None: end_time = time.time() + timeout
+        while True:
+            data = self._read()
+            if data is not None: return data
+            wait = None
+            if end_time is not None:
+                wait = end_time - time.time()
+                if wait <= 0: return None
+            select.select([self._rfd], [], [], wait)
+            self._drain()
+
+    def recv_values(self, timeout=None):
+        """
+        Receive the next message, unpacked with the format of the channel
+
+        :returns: tuple - the values, None if there is no message within timeout
+        """
+        data = self.recv(timeout)
+        if data is None: return None
+        return self.channel.fmt.unpack(data)
+
+    def close(self):
+        os.close(self._rfd)
+        try:
+            os.remove(self._fifo)
+        except OSError: pass
+
+
+_channels = {}
+
+def local_channel(name, slot_size=256, slots=1024, fmt=None):
+    """
+    Get a local channel, channels are shared within a process.  This is
+    exported to the code run by the daemon.  Example::
+
+        # Publisher
+        ch = local_channel("temperature", fmt="dd")
+        ch.publish_values(time.time(), read_temperature())
+
+        # Subscriber (in another process)
+        sub = local_channel("temperature", fmt="dd").subscribe()
+        t, temp = sub.recv_values(timeout=1.0)
+
+    See :class:`LocalChannel` for the parameters.
+
+    :rtype: LocalChannel
+    """
+    ch = _channels.get(name)
+    if ch is None:
+        ch = _channels[name] = LocalChannel(name, slot_size, slots, fmt)
+    return ch
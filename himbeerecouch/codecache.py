@@ -0,0 +1,129 @@
+import hashlib
+import marshal
+import imp
+import os
+import logging
+from . import modstore
+
+"""
+  Cache of compiled code objects for the modules delivered by the database.
+
+  Code objects are cached in memory (the supervisor compiles all modules
+  before forking, so that children inherit them) and, if a cache directory is
+  set, on disk as marshal files so that they survive restarts of the daemon.
+  The cache is keyed by the module name and a hash of its source.
+"""
+
+_memory_cache = {}
+_cache_dir = None
+# Changed when the way modules are compiled changes, so that code objects
+# cached on disk before are not used
+_key_version = "1"
+
+def set_cache_dir(path):
+    """
+    Set directory where compiled modules are stored, None disables the disk
+    cache
+
+    :param path: path to directory, created if it doesn't exist
+    :type path: str
+    """
+    global _cache_dir
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+    _cache_dir = path
+
+def cache_key(name, source):
+    """
+    :returns: str - key of a module in the cache
+    """
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    return hashlib.sha1(_key_version + "\0" + name + "\0" + source).hexdigest()
+
+def _cache_file(key):
+    return os.path.join(_cache_dir, key + ".pyc")
+
+def _load_from_disk(key):
+    try:
+        with open(_cache_file(key), "rb") as f:
+            if f.read(4) != imp.get_magic(): return None
+            return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+def _save_to_disk(key, co):
+    path = _cache_file(key)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(imp.get_magic())
+            marshal.dump(co, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logging.exception("Error saving compiled module")
+
+def compile_module(name, source):
+    """
+    Get the compiled code object for a module, compiling it only if it is not
+    already in the cache.
+
+    :param name: name of the module
+    :type name: str
+    :param source: python code
+    :type source: str
+    :rtype: code
+    """
+    key = cache_key(name, source)
+    co = _memory_cache.get(key)
+    if co is not None: return co
+    if _cache_dir is not None:
+        co = _load_from_disk(key)
+    if co is None:
+        # Sources are stored encoded (see himbeerecouch.modstore), compile
+        # the unicode source so that unicode literals are decoded correctly
+        if not isinstance(source, unicode):
+            source = source.decode("utf-8")
+        co = compile(source, "<{}>".format(name), "exec")
+        if _cache_dir is not None:
+            _save_to_disk(key, co)
+    _memory_cache[key] = co
+    return co
+
+def precompile(code_list):
+    """
+    Compile all modules of the code (as returned by
+    :func:`himbeerecouch.database.get_processes_code`) into the cache, this
+    should be called before forking the child processes.  Modules with syntax
+    errors are skipped, the error is raised when the child imports them.
+
+    :param code_list: code as returned by get_processes_code
+    :type code_list: dict
+    """
+    for o in code_list.values():
+        for name, source in modstore.resolve(o["code"], missing_ok=True).items():
+            try:
+                compile_module(name, source)
+            except SyntaxError:
+                pass
+
+def prune(code_list):
+    """
+    Remove all modules that are not part of code_list from the cache
+
+    :param code_list: code as returned by get_processes_code
+    :type code_list: dict
+    """
+    keep = set()
+    for o in code_list.values():
+        for name, source in modstore.resolve(o["code"], missing_ok=True).items():
+            keep.add(cache_key(name, source))
+    for key in _memory_cache.keys():
+        if key not in keep: del _memory_cache[key]
+    if _cache_dir is None: return
+    for fn in os.listdir(_cache_dir):
+        key, ext = os.path.splitext(fn)
+        if ext == ".pyc" and key not in keep:
+            try:
+                os.remove(os.path.join(_cache_dir, fn))
+            except OSError: pass
@@ -1,4 +1,5 @@
 import sys, os, time, atexit
+import logging
 from signal import SIGTERM, SIGHUP
 from .log import set_logging_file
 
@@ -95,8 +96,10 @@ class Daemon:
         try:
             self.run()
         except ForceRestart:
-            # Forcing a restart if it was requested
+            # Forcing a restart if it was requested, exec skips atexit so
+            # buffered log records are written now
             self.delpid()
+            logging.shutdown()
             os.execl("/etc/init.d/rspby", "/etc/init.d/rspby", "start")
 
 
@@ -1,9 +1,80 @@
 import pynedm
-from .util import getmacid, getpassword
+import hashlib
+import json
+import threading
+import time
+import random
+import logging
+from multiprocessing.util import register_after_fork
+from .util import getmacid, getpassword, read_json_file, write_json_file
+from .depgraph import reachable_modules
+from . import modstore
 
 _server = None
 _database_name = "nedm%2Fraspberries"
 
+# Sessions unused for longer than this (s) are re-authenticated, CouchDB
+# cookies expire after 10 minutes by default.
+_max_session_idle = 300
+
+# Document fields defining resource limits of the code
+_limit_fields = ["cpu_affinity", "nice", "max_rss_mb", "max_open_files"]
+
+class AccountPool(object):
+    """
+    Process-local cache of account objects (i.e. authenticated HTTP sessions),
+    keyed by server and credentials.  Reusing the account keeps the
+    connection alive and reuses the authentication cookie instead of
+    reconnecting and logging in for every request.
+
+    The pool is emptied in child processes after a fork, so that children
+    never share a connection with their parent.
+    """
+    def __init__(self):
+        self.reset()
+        # Children will automatically reset their pool
+        register_after_fork(self, AccountPool.reset)
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._accts = {}
+        self.opened = 0
+        self.reused = 0
+
+    def get(self, uri, username, password):
+        """
+        Get an account object, reusing a cached one if available
+        """
+        key = (uri, username, password)
+        now = time.time()
+        with self._lock:
+            acct, last_used = self._accts.get(key, (None, 0))
+            if acct is None or now - last_used > _max_session_idle:
+                acct = pynedm.ProcessObject(uri=uri,
+                  username = username,
+                  password = password
+                ).acct
+                self.opened += 1
+            else:
+                self.reused += 1
+            self._accts[key] = (acct, now)
+        return acct
+
+    def invalidate(self):
+        """
+        Drop all cached accounts, e.g. after a connection error
+        """
+        with self._lock:
+            self._accts = {}
+
+    def stats(self):
+        """
+        :returns: dict - number of connections opened and reused
+        """
+        return dict(opened=self.opened, reused=self.reused)
+
+_pool = AccountPool()
+
 def set_server(srvr):
     """
     Set the current server that should be used
@@ -16,25 +87,38 @@ def set_server(srvr):
 
 def get_acct():
     """
-    get the account object
+    get the account object, this is shared by all callers in this process (see
+    :class:`AccountPool`)
 
     :rtype: cloudant.Account
     """
     if _server is None:
         raise Exception("Server not valid, not yet set!")
-    po = pynedm.ProcessObject(uri=_server,
-      username = str(getmacid()),
-      password = str(getpassword())
-    )
-    return po.acct
+    return _pool.get(_server, str(getmacid()), str(getpassword()))
 
-def get_database():
+def reset_acct():
+    """
+    reset the cached account objects, the next call to :func:`get_acct`
+    reconnects
+    """
+    _pool.invalidate()
+
+def connection_stats():
+    """
+    :returns: dict - number of connections opened vs. reused in this process
+    """
+    return _pool.stats()
+
+def get_database(name=None):
     """
     get the database object
-    
+
+    :param name: name of the database (URL-quoted), default is the database
+                 of the raspberries
+    :type name: str
     :rtype: cloudant.Database
     """
-    return get_acct()[_database_name]
+    return get_acct()[name or _database_name]
 
 def send_heartbeat(db=None, **kwargs):
     """
@@ -55,7 +139,162 @@ def send_heartbeat(db=None, **kwargs):
       params=hdoc)
 
 
-def get_processes_code():
+class Heartbeat(object):
+    """
+    Writes the heartbeat document (see :func:`send_heartbeat`) only when
+    needed: the full document is written when its state (set with
+    :meth:`update`) changed, several changes within min_interval are
+    coalesced into one write.  When nothing changed, the document is only
+    rewritten as a keep-alive every keepalive_interval seconds (randomized
+    by +- jitter, so that not all devices write at the same time).
+
+    Statistics (set with :meth:`set_stats`) change all the time, they are
+    sent along with the next write but do not trigger a write themselves.
+
+    :param min_interval: minimum time (s) between two writes
+    :type min_interval: float
+    :param keepalive_interval: time (s) between keep-alive writes
+    :type keepalive_interval: float
+    :param jitter: relative randomization of keepalive_interval
+    :type jitter: float
+    """
+    def __init__(self, min_interval=2.0, keepalive_interval=60.0, jitter=0.2):
+        self.min_interval = min_interval
+        self.keepalive_interval = keepalive_interval
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self._state = {}
+        self._stats = {}
+        self._sent_state = None
+        self._last_sent = 0
+        self._next_keepalive = 0
+        self.writes = 0
+
+    def update(self, **kwargs):
+        """
+        Update the state sent in the heartbeat document, kwargs must be json
+        serializable
+        """
+        with self._lock:
+            self._state.update(kwargs)
+
+    def set_stats(self, **kwargs):
+        """
+        Update statistics sent with the next heartbeat document, kwargs must
+        be json serializable
+        """
+        with self._lock:
+            self._stats.update(kwargs)
+
+    def tick(self, db=None):
+        """
+        Write the heartbeat document if necessary, this should be called
+        regularly (e.g. on every heartbeat of the changes feed).
+
+        :param db: database
+        :returns: bool - True if the document was written
+        """
+        now = time.time()
+        with self._lock:
+            state = dict(self._state)
+            doc = dict(self._stats)
+        changed = state != self._sent_state
+        if changed and now - self._last_sent < self.min_interval: return False
+        if not changed and now < self._next_keepalive: return False
+        # The document is replaced by every write, so a keep-alive must carry
+        # the complete state as well
+        doc.update(state)
+        send_heartbeat(db=db, **doc)
+        self._sent_state = state
+        self._last_sent = now
+        self._next_keepalive = now + self.keepalive_interval * (
+                                 1 + random.uniform(-self.jitter, self.jitter))
+        self.writes += 1
+        return True
+
+
+_code_docs = {}
+_code_docs_file = None
+# Held while code documents are fetched or the module store is pruned
+_code_docs_lock = threading.Lock()
+
+def set_code_docs_file(path):
+    """
+    Set the file where the code documents (with the hashes of their modules,
+    see :mod:`himbeerecouch.modstore`) are cached, so that a restarted daemon
+    only fetches changed documents.
+
+    :param path: path to file, None to only cache in memory
+    :type path: str
+    """
+    global _code_docs, _code_docs_file
+    _code_docs_file = path
+    if path is not None:
+        _code_docs = read_json_file(path, {})
+
+def _summarize_doc(d):
+    # Sources go to the module store, only their hashes are kept
+    modules = dict((k, modstore.put(v)) for k, v in d.get("modules", {}).items())
+    if "code" in d:
+        modules["main"] = modstore.put(d["code"])
+    return { "rev" : d.get("_rev"),
+             "name" : d.get("name", d["_id"]),
+             "modules" : modules,
+             "global_modules" : dict((k, modstore.put(v))
+                                  for k, v in d.get("global_modules", {}).items()),
+             "preload" : d.get("preload", []),
+             "limits" : dict((k, d[k]) for k in _limit_fields if k in d),
+             "hot_reload" : bool(d.get("hot_reload", False)) }
+
+def _in_store(summary):
+    return all(modstore.get(h) is not None
+               for h in summary["modules"].values() + summary["global_modules"].values())
+
+def _fetch_code_docs(db, ids):
+    """
+    Get the code documents with ids, fetching only documents whose revision
+    changed since the last call.  Must be called with _code_docs_lock held.
+    """
+    res = db.post("_all_docs", params=dict(keys=ids)).json()
+    revs = dict((r["id"], r["value"]["rev"]) for r in res["rows"]
+                  if "value" in r and not r["value"].get("deleted"))
+    changed = [i for i in revs
+                 if i not in _code_docs or _code_docs[i]["rev"] != revs[i] or
+                    not _in_store(_code_docs[i])]
+    if len(changed) > 0:
+        res = db.post("_all_docs?include_docs=true", params=dict(keys=changed)).json()
+        for r in res["rows"]:
+            if r.get("doc") is not None:
+                _code_docs[r["id"]] = _summarize_doc(r["doc"])
+    removed = [i for i in _code_docs if i not in revs]
+    for i in removed: del _code_docs[i]
+    if _code_docs_file is not None and (changed or removed):
+        try:
+            write_json_file(_code_docs_file, _code_docs)
+        except:
+            logging.exception("Error writing code documents cache")
+    return _code_docs
+
+def code_hashes():
+    """
+    :returns: set - hashes of all modules of the known code documents
+    """
+    ret = set()
+    for d in _code_docs.values():
+        ret.update(d["modules"].values())
+        ret.update(d["global_modules"].values())
+    return ret
+
+def prune_modules():
+    """
+    Remove the sources of modules no longer used by any code document from
+    the module store, see :func:`himbeerecouch.modstore.prune`.  This may be
+    called while :func:`get_processes_code` runs in another thread.
+    """
+    with _code_docs_lock:
+        modstore.prune(code_hashes())
+
+def get_processes_code(runtime_imports=None):
     """
     get the process code from the database (returned by :func:`get_database`)
     This expects documents in the database that look like::
@@ -73,37 +312,92 @@ def get_processes_code():
             "name_of_global1" : "<python code>",
             "name_of_global2" : "<python code>"
           },
-          "code" : "<python code>" # This is the main module, it *must* include a
-                                   # `main` function
+          "code" : "<python code>", # This is the main module, it *must* include a
+                                    # `main` function
+          "preload" : [ "numpy", ... ], # (optional) modules that are imported in
+                                        # the daemon before starting the code
+          "cpu_affinity" : [ 2, 3 ],    # (optional) resource limits, see
+          "nice" : 10,                  # himbeerecouch.util.apply_limits
+          "max_rss_mb" : 100,
+          "max_open_files" : 256,
+          "hot_reload" : true           # (optional) changed modules are
+                                        # reloaded in the running process
         }
 
     *Note*, all of these are optional.  If e.g. ``"code"`` is omitted, then only
     ``"global_modules"`` will essentially have any effect as they will be exported
     to other code in the database.
 
+    Each code only gets the global modules it imports (directly or
+    indirectly, see :func:`himbeerecouch.depgraph.reachable_modules`), so
+    that changing a global module only changes the code importing it.
+    Modules imported by the code at runtime that are not found statically
+    can be given in runtime_imports.
+
+    Only documents whose revision changed are fetched, the module sources
+    are kept in the module store (see :mod:`himbeerecouch.modstore`) and the
+    code only refers to them by hash.  Each entry of the returned dictionary
+    looks like::
+
+        {
+          "id" : "<document id>",
+          "rev" : "<document revision>",
+          "code" : { "main" : "<hash of python code>", ... },
+          "preload" : [ ... ],
+          "limits" : { "nice" : 10, ... },
+          "hot_reload" : False,
+          "digest" : "<see code_digest>"
+        }
+
+    :param runtime_imports: names of modules imported at runtime, by document id
+    :type runtime_imports: dict
     :returns: dict - dictionary of code available in the database
     """
+    if runtime_imports is None: runtime_imports = {}
     db = get_database()
     aview = db.design("document_type").view("document_type")
     res = aview.get(params=dict(startkey=[getmacid()],
                                 endkey=[getmacid(), {}],
-                                include_docs=True,
                                 reduce=False)).json()
-
+    ids = []
+    for r in res['rows']:
+        if r["id"] not in ids: ids.append(r["id"])
     ret_dic = {}
     global_modules = {}
-    for r in res['rows']:
-       d = r['doc']
-       code = d.get('modules', {})
-       global_modules.update(d.get('global_modules', {}))
-       if 'code' in d:
-           code['main'] = d['code']
-       if "main" in code:
-           # Only add main code to return document
-           anid = d.get("name", r["id"])
-           ret_dic[anid] = { "id" : r["id"], "code" : code }
-
-    for v in ret_dic.values():
-       v.update(global_modules)
+    with _code_docs_lock:
+        docs = _fetch_code_docs(db, ids)
+        for i in ids:
+           d = docs.get(i)
+           if d is None: continue
+           global_modules.update(d["global_modules"])
+           if "main" in d["modules"]:
+               # Only add main code to return document
+               ret_dic[d["name"]] = { "id" : i,
+                                      "rev" : d["rev"],
+                                      "code" : dict(d["modules"]),
+                                      "preload" : d["preload"],
+                                      "limits" : d["limits"],
+                                      "hot_reload" : d["hot_reload"] }
+
+        for v in ret_dic.values():
+           code = dict(global_modules)
+           code.update(v["code"])
+           roots = list(v["code"]) + list(runtime_imports.get(v["id"], []))
+           # Raises if a source is missing, the documents are then fetched
+           # again at the next call
+           reachable = reachable_modules(modstore.resolve(code), roots)
+           v["code"] = dict((k, code[k]) for k in reachable)
+           v["digest"] = code_digest(v["code"])
 
     return ret_dic
+
+def code_digest(code):
+    """
+    Return a digest of a code dictionary, two dictionaries with the same
+    modules (including the exported global modules) have the same digest.
+
+    :param code: dictionary of module hashes
+    :type code: dict
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(code, sort_keys=True)).hexdigest()
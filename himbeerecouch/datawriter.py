@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import logging
+import threading
+import multiprocessing
+from .database import get_database
+
+"""
+  Buffered writing of documents to the database.
+"""
+
+_spool_dir = None
+
+def set_spool_dir(path):
+    """
+    Set the directory where writers created with :func:`data_writer` spool
+    documents that can not be written, None disables spooling
+
+    :param path: path to directory, created if it doesn't exist
+    :type path: str
+    """
+    global _spool_dir
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+    _spool_dir = path
+
+
+class DataWriter(object):
+    """
+    Writes documents to a database in batches (through _bulk_docs).
+
+    Documents are written by a background thread when batch_size documents
+    are collected or at the latest after flush_interval seconds.  Documents
+    that can not be written (e.g. because the server is not reachable) are
+    appended to spool_file and written once writing succeeds again.  Without
+    spool file, they are kept in memory (at most max_buffered documents, the
+    oldest are dropped).
+
+    :param database: name of the database (URL-quoted), default is the
+                     database of the raspberries
+    :type database: str
+    :param batch_size: number of documents written at once
+    :type batch_size: int
+    :param flush_interval: maximum time (s) a document is buffered
+    :type flush_interval: float
+    :param spool_file: path of the spool file
+    :type spool_file: str
+    :param max_spool_bytes: maximum size of the spool file
+    :type max_spool_bytes: int
+    :param max_buffered: maximum number of documents kept in memory
+    :type max_buffered: int
+    """
+    def __init__(self, database=None, batch_size=200, flush_interval=5.0,
+                 spool_file=None, max_spool_bytes=50*2**20, max_buffered=20000):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_file = spool_file
+        self.max_spool_bytes = max_spool_bytes
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._docs = []
+        self._wake = threading.Event()
+        self._flush_requested = False
+        self._stop = False
+        self._thread = None
+        self._failing = False
+        self.written = 0
+        self.spooled = 0
+        self.dropped = 0
+        self._last_stats = (time.time(), 0)
+
+    def write(self, doc):
+        """
+        Add a document (dict), returns immediately
+        """
+        self.write_many([doc])
+
+    def write_many(self, docs):
+        """
+        Add a list of documents, returns immediately
+        """
+        with self._lock:
+            self._docs.extend(docs)
+            over = len(self._docs) - self.max_buffered
+            if over > 0:
+                del self._docs[:over]
+                self.dropped += over
+            if len(self._docs) >= self.batch_size: self._wake.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop:
+            end_time = time.time() + self.flush_interval
+            while not self._flush_requested and not self._wake.is_set():
+                remaining = end_time - time.time()
+                if remaining <= 0: break
+                self._wake.wait(min(remaining, 0.1))
+            self._wake.clear()
+            self._flush_requested = False
+            self.flush()
+
+    def request_flush(self):
+        """
+        Let the background thread write the buffered documents now.  This
+        only sets a flag checked by the thread (within 0.1 s) and takes no
+        lock, so it may be called from a signal handler, e.g. in a quit
+        notification.
+        """
+        self._flush_requested = True
+
+    def flush(self):
+        """
+        Write all buffered (and spooled) documents, blocks until done
+        """
+        with self._write_lock:
+            with self._lock:
+                docs = self._docs
+                self._docs = []
+            sent = True
+            for i in range(0, len(docs), self.batch_size):
+                batch = docs[i:i+self.batch_size]
+                if sent: sent = self._post(batch)
+                if not sent: self._keep(batch)
+            if sent: self._resend_spool()
+
+    def _post(self, docs):
+        try:
+            get_database(self.database).post("_bulk_docs", params=dict(docs=docs)).json()
+        except:
+            # Only report the first error of an outage
+            if not self._failing:
+                logging.exception("Error writing documents to database")
+            self._failing = True
+            return False
+        self._failing = False
+        self.written += len(docs)
+        return True
+
+    def _keep(self, docs):
+        if self.spool_file is None:
+            with self._lock:
+                self._docs[:0] = docs
+                over = len(self._docs) - self.max_buffered
+                if over > 0:
+                    del self._docs[:over]
+                    self.dropped += over
+            return
+        try:
+            if (os.path.exists(self.spool_file) and
+                os.path.getsize(self.spool_file) > self.max_spool_bytes):
+                self.dropped += len(docs)
+                return
+            with open(self.spool_file, "a") as f:
+                for d in docs: f.write(json.dumps(d) + "\n")
+            self.spooled += len(docs)
+        except (IOError, OSError):
+            self.dropped += len(docs)
+
+    def _resend_spool(self):
+        if self.spool_file is None or not os.path.exists(self.spool_file): return
+        try:
+            with open(self.spool_file) as f:
+                docs = [json.loads(l) for l in f if l.strip()]
+        except (IOError, ValueError):
+            logging.exception("Error reading spool file, removing it")
+            docs = []
+        for i in range(0, len(docs), self.batch_size):
+            if not self._post(docs[i:i+self.batch_size]):
+                # Keep the rest for later
+                tmp_file = self.spool_file + ".tmp"
+                with open(tmp_file, "w") as f:
+                    for d in docs[i:]: f.write(json.dumps(d) + "\n")
+                os.rename(tmp_file, self.spool_file)
+                return
+        os.remove(self.spool_file)
+
+    def spool_size(self):
+        """
+        :returns: int - size (bytes) of the spool file
+        """
+        try:
+            return os.path.getsize(self.spool_file)
+        except (TypeError, OSError):
+            return 0
+
+    def stats(self):
+        """
+        :returns: dict - number of documents written, spooled, dropped and
+                  pending (in memory), the size of the spool file and the
+                  write rate (documents/s) since the last call
+        """
+        now = time.time()
+        last_time, last_written = self._last_stats
+        self._last_stats = (now, self.written)
+        rate = 0.0
+        if now > last_time:
+            rate = round((self.written - last_written)/(now - last_time), 2)
+        with self._lock:
+            pending = len(self._docs)
+        return dict(written=self.written, spooled=self.spooled,
+                    dropped=self.dropped, pending=pending,
+                    spool_bytes=self.spool_size(), rate=rate)
+
+    def close(self):
+        """
+        Stop the background thread and write the remaining documents
+        """
+        self._stop = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+_writers = {}
+
+def data_writer(database=None, **kwargs):
+    """
+    Get the :class:`DataWriter` for a database, writers are shared within a
+    process.  This is exported to the code run by the daemon.  If the daemon
+    has a spool directory (see :func:`set_spool_dir`), documents that can not
+    be written are spooled there.
+
+    :param database: name of the database (URL-quoted), default is the
+                     database of the raspberries
+    :type database: str
+    :param kwargs: passed to :class:`DataWriter` when it is created
+    :rtype: DataWriter
+    """
+    w = _writers.get(database)
+    if w is None:
+        if _spool_dir is not None and "spool_file" not in kwargs:
+            fn = "{}_{}.json".format(multiprocessing.current_process().name,
+                                     database or "default")
+            kwargs["spool_file"] = os.path.join(_spool_dir,
+                                     "".join(c if c.isalnum() or c in "._-" else "_" for c in fn))
+        w = _writers[database] = DataWriter(database, **kwargs)
+    return w
+
+def flush_data_writers():
+    """
+    Write the buffered documents of all writers of this process
+    """
+    for w in _writers.values():
+        w.flush()
+
+def request_flush_data_writers():
+    """
+    Request all writers of this process to write their buffered documents
+    without waiting, see :meth:`DataWriter.request_flush`
+    """
+    for w in _writers.values():
+        w.request_flush()
+
+def close_data_writers():
+    """
+    Close all writers of this process, see :meth:`DataWriter.close`
+    """
+    for w in _writers.values():
+        w.close()
+    _writers.clear()
+
+def data_writer_stats():
+    """
+    :returns: dict - statistics of the writers of this process, by database
+    """
+    return dict((db or "default", w.stats()) for db, w in _writers.items())
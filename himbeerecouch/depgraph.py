@@ -0,0 +1,100 @@
+import ast
+from .codecache import cache_key
+
+"""
+  Import dependencies between the modules delivered by the database.
+
+  The imports of a module are found by static analysis: import statements
+  as well as calls of __import__/import_module with a string literal.  A
+  module importing with a computed name (or with a syntax error) is
+  "dynamic", i.e. it may import anything.
+"""
+
+_import_funcs = ["__import__", "import_module"]
+
+_cache = {}
+
+class _ImportVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.names = set()
+        self.dynamic = False
+
+    def _add(self, name):
+        # "a.b.c" imports a, a.b and a.b.c
+        parts = name.split(".")
+        for i in range(len(parts)):
+            self.names.add(".".join(parts[:i+1]))
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._add(alias.name)
+
+    def visit_ImportFrom(self, node):
+        if node.module:
+            self._add(node.module)
+        for alias in node.names:
+            # "from a import b" may import the module a.b (or b for relative
+            # imports)
+            if node.module:
+                self._add("{}.{}".format(node.module, alias.name))
+            else:
+                self._add(alias.name)
+
+    def visit_Call(self, node):
+        func = node.func
+        name = None
+        if isinstance(func, ast.Name): name = func.id
+        elif isinstance(func, ast.Attribute): name = func.attr
+        if name in _import_funcs:
+            if len(node.args) > 0 and isinstance(node.args[0], ast.Str):
+                self._add(node.args[0].s)
+            else:
+                self.dynamic = True
+        self.generic_visit(node)
+
+
+def module_imports(name, source):
+    """
+    Find the imports of a module
+
+    :param name: name of the module
+    :type name: str
+    :param source: python code
+    :type source: str
+    :returns: (set, bool) - names of imported modules, True if the module
+              imports dynamically
+    """
+    key = cache_key(name, source)
+    ret = _cache.get(key)
+    if ret is not None: return ret
+    v = _ImportVisitor()
+    try:
+        if isinstance(source, unicode): source = source.encode("utf-8")
+        v.visit(ast.parse(source, "<{}>".format(name)))
+    except SyntaxError:
+        v.dynamic = True
+    if len(_cache) > 1000: _cache.clear()
+    ret = _cache[key] = (frozenset(v.names), v.dynamic)
+    return ret
+
+def reachable_modules(modules, roots):
+    """
+    Find the modules reachable (by imports) from roots
+
+    :param modules: dictionary of modules (in string format)
+    :type modules: dict
+    :param roots: names of the modules to start from
+    :type roots: list
+    :returns: set - names of reachable modules of modules, all if a
+              reachable module imports dynamically
+    """
+    seen = set()
+    todo = [r for r in roots if r in modules]
+    while todo:
+        name = todo.pop()
+        if name in seen: continue
+        seen.add(name)
+        imports, dynamic = module_imports(name, modules[name])
+        if dynamic: return set(modules)
+        todo.extend(n for n in imports if n in modules and n not in seen)
+    return seen
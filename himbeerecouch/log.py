@@ -3,44 +3,258 @@ import logging
 import traceback
 import threading
 import multiprocessing
-from multiprocessing.util import register_after_fork
+from multiprocessing.util import register_after_fork, Finalize
 import atexit
 import Queue
+import collections
+import time
+import os
+import gzip
+import shutil
 from .util import getmacid
-from logging import FileHandler as FH
 from logging import StreamHandler as SH
 
 # ============================================================================
 # Define Log Handler
 # ============================================================================
+class BufferedRotatingFileHandler(logging.FileHandler):
+    """buffered, rotating log file handler
+
+    Formatted records are collected in memory and written to the file in one
+    go when buffer_size bytes are collected, when the oldest buffered record
+    is older than flush_interval seconds or when a record with at least
+    flush_level arrives.  This keeps the number of writes to the SD card low.
+    The time threshold is only checked when records arrive or when
+    :meth:`flush_if_due` is called (the receive thread of
+    :class:`MPLogHandler` does this regularly).
+
+    When the file would grow beyond max_bytes it is rotated: out_file is
+    moved to out_file.1(.gz), out_file.1(.gz) to out_file.2(.gz), ... and at
+    most backup_count old files are kept.
+
+    :param filename: name of output file
+    :type filename: str
+    :param max_bytes: maximum size of a log file, 0 disables rotation
+    :type max_bytes: int
+    :param backup_count: number of rotated files kept
+    :type backup_count: int
+    :param compress: gzip rotated files
+    :type compress: bool
+    :param buffer_size: number of bytes buffered before writing
+    :type buffer_size: int
+    :param flush_interval: maximum time (s) a record is buffered
+    :type flush_interval: float
+    :param flush_level: records with this level (or higher) are written immediately
+    :type flush_level: int
+
+    """
+    def __init__(self, filename, max_bytes = 5*2**20,
+                                 backup_count = 5,
+                                 compress = True,
+                                 buffer_size = 64*2**10,
+                                 flush_interval = 5.0,
+                                 flush_level = logging.ERROR):
+        logging.FileHandler.__init__(self, filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.writes = 0
+        self.rotations = 0
+        self._reset_buffer()
+        # Children never write to the file, drop what they inherited
+        register_after_fork(self, BufferedRotatingFileHandler._reset_buffer)
+
+    def _reset_buffer(self):
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._first_buffered = None
+
+    def emit(self, record):
+        try:
+            self.write_formatted(self.format(record), record.levelno)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def write_formatted(self, msg, levelno):
+        """
+        Buffer an already formatted record
+        """
+        if isinstance(msg, unicode):
+            msg = msg.encode("utf-8")
+        self.acquire()
+        try:
+            if self._first_buffered is None:
+                self._first_buffered = time.time()
+            self._buffer.append(msg + "\n")
+            self._buffered_bytes += len(msg) + 1
+            if (levelno >= self.flush_level or
+                self._buffered_bytes >= self.buffer_size or
+                time.time() - self._first_buffered >= self.flush_interval):
+                self._write_buffer()
+        finally:
+            self.release()
+
+    def flush_if_due(self):
+        """
+        Write the buffer if the oldest record is older than flush_interval
+        """
+        self.acquire()
+        try:
+            if (self._first_buffered is not None and
+                time.time() - self._first_buffered >= self.flush_interval):
+                self._write_buffer()
+        finally:
+            self.release()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._write_buffer()
+        finally:
+            self.release()
+
+    def _write_buffer(self):
+        if not self._buffer: return
+        data = "".join(self._buffer)
+        self._reset_buffer()
+        if self.stream is None:
+            self.stream = self._open()
+        if self.max_bytes > 0:
+            self.stream.seek(0, 2)
+            pos = self.stream.tell()
+            if pos > 0 and pos + len(data) > self.max_bytes:
+                self.do_rollover()
+        self.stream.write(data)
+        self.stream.flush()
+        self.writes += 1
+
+    def _backup_name(self, i):
+        name = "{}.{}".format(self.baseFilename, i)
+        if self.compress: name += ".gz"
+        return name
+
+    def do_rollover(self):
+        """
+        Rotate the log files, see class description
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = self._backup_name(i)
+                if os.path.exists(src):
+                    os.rename(src, self._backup_name(i + 1))
+            dst = self._backup_name(1)
+            if self.compress:
+                with open(self.baseFilename, "rb") as f_in:
+                    f_out = gzip.open(dst + ".tmp", "wb")
+                    try:
+                        shutil.copyfileobj(f_in, f_out)
+                    finally:
+                        f_out.close()
+                os.rename(dst + ".tmp", dst)
+                os.remove(self.baseFilename)
+            else:
+                os.rename(self.baseFilename, dst)
+        else:
+            os.remove(self.baseFilename)
+        self.stream = self._open()
+        self.rotations += 1
+
+    def close(self):
+        self.flush()
+        logging.FileHandler.close(self)
+
+
 class MPLogHandler(logging.Handler):
     """multiprocessing log handler
 
     This handler makes it possible for several processes
     to log to the same file by using a queue.
 
+    Child processes format their records and send them in batches (when
+    batch_size records are buffered or after flush_interval seconds) through
+    a bounded queue.  When the queue is full, records are buffered in the
+    child (up to max_buffered records), beyond that the overflow policy
+    decides: "drop_new" drops new records, "drop_old" drops the oldest
+    buffered records and "block" waits (at most block_timeout seconds) for
+    the parent to catch up.  The number of dropped and delayed records of
+    each child is available in the parent from :meth:`stats`.
+
     :param out_file: name of output file, if None then is output to stdout/stderr
     :type out_file: str
+    :param batch_size: number of records sent at once
+    :type batch_size: int
+    :param flush_interval: maximum time (s) a record is buffered in the child
+    :type flush_interval: float
+    :param max_queued: maximum number of batches in the queue
+    :type max_queued: int
+    :param max_buffered: maximum number of records buffered in a child
+    :type max_buffered: int
+    :param overflow: overflow policy, "drop_new", "drop_old" or "block"
+    :type overflow: str
+    :param block_timeout: maximum time (s) to block with overflow "block"
+    :type block_timeout: float
+    :param file_options: keyword arguments for the
+                         :class:`BufferedRotatingFileHandler` writing out_file
+    :type file_options: dict
 
     """
-    def __init__(self, out_file = None):
+    def __init__(self, out_file = None,
+                       batch_size = 100,
+                       flush_interval = 0.5,
+                       max_queued = 100,
+                       max_buffered = 10000,
+                       overflow = "drop_old",
+                       block_timeout = 1.0,
+                       file_options = None):
         logging.Handler.__init__(self)
 
+        if overflow not in ["drop_new", "drop_old", "block"]:
+            raise Exception("Unknown overflow policy: {}".format(overflow))
         if out_file is not None:
-            self._handler = FH(out_file)
+            self._handler = BufferedRotatingFileHandler(out_file,
+                                                        **(file_options or {}))
         else:
             self._handler = SH()
-        self.queue = multiprocessing.Queue(-1)
+        self.queue = multiprocessing.Queue(max_queued)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_buffered = max_buffered
+        self._overflow = overflow
+        self._block_timeout = block_timeout
 
         atexit.register(logging.shutdown)
         self._thrd = None
         self._is_child = False
+        self._child_stats = {}
+        self._sinks = []
 
         # Children will automatically register themselves as chilcren
         register_after_fork(self, MPLogHandler.set_is_child)
 
     def set_is_child(self):
+        # Children may be forked while another thread holds the logging locks,
+        # which are not reinitialised after fork in python 2
+        self.createLock()
+        logging._lock = threading.RLock()
         self._is_child = True
+        self._buffer = []
+        # Reentrant, records may be logged from a signal handler
+        self._buffer_lock = threading.RLock()
+        self._dropped = 0
+        self._delayed = 0
+        self._counted_delayed = 0
+        self._flush_thrd = None
+        # Send buffered records when the child exits (before the queue is
+        # closed), waiting for the parent if necessary
+        Finalize(None, self._send_buffer, args=(True,), exitpriority=20)
 
     def start_recv_thread(self):
         if self._thrd: return
@@ -57,8 +271,12 @@ class MPLogHandler(logging.Handler):
     def receive(self):
         while not self._shutdown:
             try:
-                record = self.queue.get(True, 0.3)
-                self._handler.emit(record)
+                if isinstance(self._handler, BufferedRotatingFileHandler):
+                    self._handler.flush_if_due()
+                name, stats, records = self.queue.get(True, 0.3)
+                self._child_stats[name] = stats
+                for r in records:
+                    self.handle_formatted(*r)
 
             except (Queue.Empty,IOError):
                 pass
@@ -69,6 +287,41 @@ class MPLogHandler(logging.Handler):
             except:
                 traceback.print_exc(file=sys.stderr)
 
+    def handle_formatted(self, created, levelno, name, msg):
+        """
+        Output a formatted record (sent from a child process)
+        """
+        h = self._handler
+        if isinstance(h, BufferedRotatingFileHandler):
+            h.write_formatted(msg, levelno)
+        else:
+            h.acquire()
+            try:
+                h.stream.write(msg + "\n")
+                h.flush()
+            finally:
+                h.release()
+        for s in self._sinks:
+            s.write(created, levelno, name, msg)
+
+    def add_sink(self, sink):
+        """
+        Add a sink receiving all records (of the parent and the children),
+        see e.g. :class:`himbeerecouch.logsink.CouchDBLogSink`.  Sinks must
+        implement write(created, levelno, process_name, formatted_msg).
+        """
+        self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        self._sinks = [s for s in self._sinks if s is not sink]
+
+    def stats(self):
+        """
+        :returns: dict - number of dropped and delayed records per child
+                  process (as last reported by the child)
+        """
+        return dict(self._child_stats)
+
     def shutdown_recv_thread(self):
         if self._thrd:
             self._shutdown = True
@@ -76,7 +329,57 @@ class MPLogHandler(logging.Handler):
             self._thrd = None
 
     def send(self, s):
-        self.queue.put_nowait(s)
+        """
+        Buffer a formatted record in the child, it is sent with the next batch
+        """
+        if self._flush_thrd is None:
+            self._flush_thrd = threading.Thread(target=self._flush_loop)
+            self._flush_thrd.daemon = True
+            self._flush_thrd.start()
+        if self._overflow == "block" and len(self._buffer) >= self._max_buffered:
+            self.flush()
+        with self._buffer_lock:
+            if len(self._buffer) >= self._max_buffered:
+                self._dropped += 1
+                if self._overflow != "drop_old": return
+                self._buffer.pop(0)
+                self._counted_delayed = max(0, self._counted_delayed - 1)
+            self._buffer.append(s)
+            if len(self._buffer) < self._batch_size: return
+        self.flush()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Send the records buffered in a child process
+        """
+        if not self._is_child:
+            self._handler.flush()
+            return
+        self._send_buffer(self._overflow == "block")
+
+    def _send_buffer(self, block):
+        name = multiprocessing.current_process().name
+        with self._buffer_lock:
+            while len(self._buffer) > 0:
+                batch = self._buffer[:self._batch_size]
+                stats = dict(dropped=self._dropped, delayed=self._delayed)
+                try:
+                    if block:
+                        self.queue.put((name, stats, batch), True, self._block_timeout)
+                    else:
+                        self.queue.put_nowait((name, stats, batch))
+                except Queue.Full:
+                    # Keep the records for the next flush, count each only once
+                    self._delayed += len(self._buffer) - self._counted_delayed
+                    self._counted_delayed = len(self._buffer)
+                    break
+                del self._buffer[:len(batch)]
+                self._counted_delayed = max(0, self._counted_delayed - len(batch))
 
     def _format_record(self, record):
         if record.args:
@@ -90,21 +393,92 @@ class MPLogHandler(logging.Handler):
 
     def emit(self, record):
         try:
-            s = self._format_record(record)
-            # If we are a child, then send the record, otherwise simply emit it
-            if self._is_child: self.send(s)
-            else: self._handler.emit(s)
+            # If we are a child, then send the formatted record, otherwise simply emit it
+            if self._is_child:
+                self.send((record.created, record.levelno, record.processName,
+                           self.format(record)))
+            else:
+                self._handler.emit(self._format_record(record))
+                if self._sinks:
+                    msg = self.format(record)
+                    for s in self._sinks:
+                        s.write(record.created, record.levelno, record.processName, msg)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
 
     def close(self):
-        self._handler.close()
+        if self._is_child:
+            self.flush()
+        # Stop receiving before closing the output
         self.shutdown_recv_thread()
+        self._handler.close()
         logging.Handler.close(self)
 
 
+class LogRingBuffer(object):
+    """
+    Log sink (see :meth:`MPLogHandler.add_sink`) keeping the most recent
+    records of each process in memory.
+
+    :param size: number of records kept per process
+    :type size: int
+    """
+    def __init__(self, size=2000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._records = {}
+
+    def write(self, created, levelno, name, msg):
+        with self._lock:
+            recs = self._records.get(name)
+            if recs is None:
+                recs = self._records[name] = collections.deque(maxlen=self.size)
+            recs.append((created, levelno, msg))
+
+    def names(self):
+        """
+        :returns: list - names of processes with records
+        """
+        with self._lock:
+            return sorted(self._records)
+
+    def query(self, name=None, level=None, limit=100):
+        """
+        Get recent records
+
+        :param name: name of the process, None for all processes
+        :type name: str
+        :param level: minimum level (e.g. logging.WARNING or "WARNING")
+        :param limit: maximum number of records returned (the most recent ones)
+        :type limit: int
+        :returns: list - formatted records, oldest first
+        """
+        if isinstance(level, basestring):
+            level = logging.getLevelName(level.upper())
+            if not isinstance(level, int):
+                raise Exception("Unknown log level")
+        with self._lock:
+            if name is None:
+                recs = [r for v in self._records.values() for r in v]
+            else:
+                recs = list(self._records.get(name, []))
+        if level is not None:
+            recs = [r for r in recs if r[1] >= level]
+        recs.sort(key=lambda r: r[0])
+        if limit is not None:
+            recs = recs[-limit:]
+        return [r[2] for r in recs]
+
+    def forget(self, name):
+        """
+        Remove the records of a process
+        """
+        with self._lock:
+            self._records.pop(name, None)
+
+
 _logger = logging.getLogger()
 _logger.setLevel(logging.INFO)
 _formatter = logging.Formatter("%(asctime)s [RSPBY/%(processName)s] %(levelname)s %(message)s")
@@ -115,11 +489,15 @@ log = _logger.info
 requests_log = logging.getLogger("requests.packages.urllib3")
 requests_log.setLevel(logging.WARN)
 
-def set_logging_file(out_file=None):
+def set_logging_file(out_file=None, **kwargs):
+    """
+    Log to out_file (stdout/stderr if None), kwargs are passed to
+    :class:`MPLogHandler`
+    """
     global _handler
     if _handler is not None:
         _logger.removeHandler(_handler)
-    _handler = MPLogHandler(out_file)
+    _handler = MPLogHandler(out_file, **kwargs)
     _handler.setFormatter(_formatter)
     _logger.addHandler(_handler)
 
@@ -132,3 +510,23 @@ def start_child_logging():
 def stop_child_logging():
     if _handler:
         _handler.shutdown_recv_thread()
+
+def add_log_sink(sink):
+    """
+    Add a sink to the log handler, see :meth:`MPLogHandler.add_sink`
+    """
+    if _handler:
+        _handler.add_sink(sink)
+
+def remove_log_sink(sink):
+    if _handler:
+        _handler.remove_sink(sink)
+
+def child_logging_stats():
+    """
+    :returns: dict - number of dropped and delayed log records of child
+              processes, see :meth:`MPLogHandler.stats`
+    """
+    if _handler:
+        return _handler.stats()
+    return {}
@@ -0,0 +1,132 @@
+import time
+import logging
+import threading
+from .datawriter import DataWriter
+from .util import getmacid
+
+"""
+  Forwarding of log records to a CouchDB database.
+"""
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter
+
+    :param rate: tokens added per second
+    :type rate: float
+    :param burst: maximum number of tokens
+    :type burst: float
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.time()
+
+    def take(self):
+        """
+        :returns: bool - True if a token was available
+        """
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+        self._last = now
+        if self._tokens < 1: return False
+        self._tokens -= 1
+        return True
+
+
+class CouchDBLogSink(object):
+    """
+    Log sink (see :meth:`himbeerecouch.log.MPLogHandler.add_sink`) writing
+    the log records to a database, one document per record::
+
+        {
+          "type" : "<macid>_log",
+          "time" : <time of the record (s since epoch)>,
+          "level" : "INFO",
+          "process" : "<name of the process>",
+          "msg" : "<formatted record>"
+        }
+
+    Records are written in batches by a
+    :class:`himbeerecouch.datawriter.DataWriter`, records that can not be
+    written are spooled to spool_file.  The records of each process are rate
+    limited (rate records/s, with bursts of up to burst records), records
+    above the limit are dropped and counted.
+
+    :param database: name of the log database (URL-quoted), default is the
+                     database of the raspberries
+    :type database: str
+    :param batch_size: number of records written at once
+    :type batch_size: int
+    :param flush_interval: maximum time (s) a record is buffered
+    :type flush_interval: float
+    :param spool_file: path of the spool file, if None unwritten records are
+                       kept in memory
+    :type spool_file: str
+    :param max_spool_bytes: maximum size of the spool file
+    :type max_spool_bytes: int
+    :param max_buffered: maximum number of records kept in memory
+    :type max_buffered: int
+    :param rate: records per second allowed per process
+    :type rate: float
+    :param burst: maximum burst of records per process
+    :type burst: float
+    :param level: minimum level of forwarded records
+    :type level: int
+    """
+    def __init__(self, database=None, batch_size=200, flush_interval=10.0,
+                 spool_file=None, max_spool_bytes=10*2**20, max_buffered=5000,
+                 rate=10.0, burst=200, level=logging.INFO):
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        self._writer = DataWriter(database, batch_size=batch_size,
+                                  flush_interval=flush_interval,
+                                  spool_file=spool_file,
+                                  max_spool_bytes=max_spool_bytes,
+                                  max_buffered=max_buffered)
+        self._type = "{}_log".format(getmacid())
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.rate_limited = {}
+
+    def write(self, created, levelno, name, msg):
+        """
+        Add a formatted record
+        """
+        if levelno < self.level: return
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = TokenBucket(self.rate, self.burst)
+            if not bucket.take():
+                self.rate_limited[name] = self.rate_limited.get(name, 0) + 1
+                return
+        self._writer.write({ "type" : self._type,
+                             "time" : created,
+                             "level" : logging.getLevelName(levelno),
+                             "process" : name,
+                             "msg" : msg })
+
+    def flush(self):
+        """
+        Write the buffered and spooled records
+        """
+        self._writer.flush()
+
+    def stats(self):
+        """
+        :returns: dict - see :meth:`himbeerecouch.datawriter.DataWriter.stats`,
+                  additionally the number of rate limited records per process
+        """
+        ret = self._writer.stats()
+        with self._lock:
+            ret["rate_limited"] = dict(self.rate_limited)
+        return ret
+
+    def close(self):
+        """
+        Stop writing and write the remaining records
+        """
+        self._writer.close()
@@ -1,26 +1,329 @@
 import socket
 import signal
 import json
+import threading
+import Queue
+import os
+import time
+import gzip
+import base64
+import select
+import tempfile
 from .util import getmacid, getpassword, blink_leds, stop_blinking
 from .log import log
+from .database import get_database
 import logging
 
 _broadcast_port = 53000
 _max_broadcast_packet = 65000
 
-def execute_cmd(dic):
+# Defaults for the command executor
+_cmd_workers = 2
+_cmd_max_pending = 50
+_cmd_timeout = 600
+_cmd_batch_size = 20
+_cmd_flush_interval = 1.0
+
+# Defaults for streamed commands
+_max_inline_output = 64*1024
+_progress_interval = 5.0
+_progress_tail = 4096
+
+def execute_cmd(dic, timeout=None):
     """
 	Execute a shell command, result of command is saved in dic as "ret"
 
     :param dic: dict, should contain "cmd"
     :param type: dict
+    :param timeout: time (s) after which the command is killed, None waits forever
+    :type timeout: float
+    """
+    import subprocess as _sp
+    try:
+        p = _sp.Popen(dic["cmd"], stderr=_sp.PIPE, stdout=_sp.PIPE)
+        timed_out = []
+        def _kill():
+            timed_out.append(True)
+            try:
+                p.kill()
+            except OSError: pass
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, _kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            dic["ret"] = list(p.communicate())
+        finally:
+            if timer is not None: timer.cancel()
+        if timed_out:
+            dic["ret"][1] += "\nKilled after timeout ({} s)".format(timeout)
+    except Exception as e:
+        dic["ret"] = [None,repr(e)]
+
+
+class _OutputStream(object):
+    """
+    Collects the output of one stream (stdout or stderr) of a command.  The
+    first max_inline bytes are kept in memory, the complete output is
+    compressed into a temporary file.
+    """
+    def __init__(self, name, max_inline):
+        self.name = name
+        self.max_inline = max_inline
+        self.size = 0
+        self.head = []
+        self.tail = ""
+        self._file = tempfile.TemporaryFile()
+        self._gz = gzip.GzipFile(fileobj=self._file, mode="wb")
+
+    def write(self, data):
+        if self.size < self.max_inline:
+            self.head.append(data[:self.max_inline - self.size])
+        self.size += len(data)
+        self.tail = (self.tail + data)[-_progress_tail:]
+        self._gz.write(data)
+
+    def result(self):
+        """
+        :returns: (inline output, attachment or None)
+        """
+        self._gz.close()
+        inline = "".join(self.head)
+        attachment = None
+        if self.size > self.max_inline:
+            att_name = self.name + ".gz"
+            inline += "\n... truncated, complete output ({} bytes) in attachment {}".format(self.size, att_name)
+            self._file.seek(0)
+            attachment = (att_name, {
+              "content_type" : "application/gzip",
+              "data" : base64.b64encode(self._file.read())
+            })
+        self._file.close()
+        return inline, attachment
+
+
+def stream_cmd(dic, timeout=None, progress=None,
+               progress_interval=_progress_interval,
+               max_inline=_max_inline_output):
+    """
+	Execute a shell command, reading its output incrementally.  The result is
+    saved in dic as "ret" like :func:`execute_cmd`, but output exceeding
+    max_inline bytes is only saved (gzip compressed) as an attachment of the
+    document (i.e. in "_attachments").
+
+    :param dic: dict, should contain "cmd"
+    :param type: dict
+    :param timeout: time (s) after which the command is killed, None waits forever
+    :type timeout: float
+    :param progress: called as progress(dic) every progress_interval seconds
+                     while the command runs, dic["progress"] then contains the
+                     number of bytes and the end of the output so far
+    :type progress: function
+    :param max_inline: maximum number of bytes saved directly in the document
+    :type max_inline: int
     """
     import subprocess as _sp
     try:
         p = _sp.Popen(dic["cmd"], stderr=_sp.PIPE, stdout=_sp.PIPE)
-        dic["ret"] = list(p.communicate())
     except Exception as e:
         dic["ret"] = [None,repr(e)]
+        return
+
+    streams = { p.stdout.fileno() : _OutputStream("stdout", max_inline),
+                p.stderr.fileno() : _OutputStream("stderr", max_inline) }
+    out, err = streams[p.stdout.fileno()], streams[p.stderr.fileno()]
+    open_fds = streams.keys()
+    start_time = time.time()
+    next_progress = start_time + progress_interval
+    timed_out = False
+    while len(open_fds) > 0:
+        ready, _, _ = select.select(open_fds, [], [], 0.5)
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if data: streams[fd].write(data)
+            else: open_fds.remove(fd)
+        now = time.time()
+        if timeout is not None and not timed_out and now - start_time > timeout:
+            timed_out = True
+            try:
+                p.kill()
+            except OSError: pass
+        if progress is not None and now > next_progress:
+            next_progress = now + progress_interval
+            dic["progress"] = { "bytes" : [out.size, err.size],
+                                "tail" : [out.tail, err.tail] }
+            try:
+                progress(dic)
+            except:
+                logging.exception("Error sending command progress")
+    # The command may have closed its output and still be running
+    while p.poll() is None:
+        if timeout is not None and not timed_out and time.time() - start_time > timeout:
+            timed_out = True
+            try:
+                p.kill()
+            except OSError: pass
+        time.sleep(0.1)
+
+    dic["ret"] = []
+    for o in [out, err]:
+        inline, attachment = o.result()
+        dic["ret"].append(inline)
+        if attachment is not None:
+            dic.setdefault("_attachments", {})[attachment[0]] = attachment[1]
+    if timed_out:
+        dic["ret"][1] += "\nKilled after timeout ({} s)".format(timeout)
+    dic.pop("progress", None)
+
+
+class CommandExecutor(object):
+    """
+    Executes command documents (see :func:`execute_cmd`) in a bounded pool of
+    worker threads, so that the caller (i.e. the changes feed) never waits
+    for a command to finish.  Every command is killed after a timeout, which
+    can be set per document with the field "timeout" (s).  The results are
+    written back to the database in batches via ``_bulk_docs``.
+
+    Documents with the field "stream" set are run with :func:`stream_cmd`,
+    progress is then written to the document while the command runs.
+
+    Other kinds of commands are supported with handlers: if a document
+    contains a key of handlers (instead of "cmd"), the corresponding
+    function is called with the document and the timeout, and should save
+    its result in the document as "ret".
+
+    :param workers: number of commands run concurrently
+    :type workers: int
+    :param max_pending: maximum number of commands waiting to be run
+    :type max_pending: int
+    :param timeout: default timeout (s) of a command
+    :type timeout: float
+    :param batch_size: number of results to write back at once
+    :type batch_size: int
+    :param flush_interval: maximum time (s) a result waits to be written back
+    :type flush_interval: float
+    :param handlers: functions handling other commands, keyed by document field
+    :type handlers: dict
+    """
+    def __init__(self, workers=_cmd_workers,
+                       max_pending=_cmd_max_pending,
+                       timeout=_cmd_timeout,
+                       batch_size=_cmd_batch_size,
+                       flush_interval=_cmd_flush_interval,
+                       handlers=None):
+        self._handlers = handlers or {}
+        self._queue = Queue.Queue(max_pending)
+        self._timeout = timeout
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._results = []
+        self._in_flight = set()
+        self._flush_now = threading.Event()
+        self._stopped = False
+
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+        self._flusher = threading.Thread(target=self._flush_loop)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def submit(self, dic):
+        """
+        Submit a command document for execution, returns immediately.
+
+        :returns: bool - False if the command is already being handled
+        """
+        with self._lock:
+            if dic["_id"] in self._in_flight: return False
+            self._in_flight.add(dic["_id"])
+        try:
+            self._queue.put_nowait(dic)
+        except Queue.Full:
+            log("Command queue full, rejecting command ({})".format(dic["_id"]))
+            dic["ret"] = [None, "Rejected, too many pending commands"]
+            self._add_result(dic)
+        return True
+
+    def _add_result(self, dic):
+        with self._lock:
+            self._results.append(dic)
+            if len(self._results) >= self._batch_size:
+                self._flush_now.set()
+
+    def _work(self):
+        while True:
+            dic = self._queue.get()
+            if dic is None: break
+            timeout = dic.get("timeout", self._timeout)
+            handler = [self._handlers[k] for k in self._handlers if k in dic]
+            if len(handler) > 0:
+                try:
+                    handler[0](dic, timeout)
+                except Exception as e:
+                    logging.exception("Error handling command")
+                    dic["ret"] = [None, repr(e)]
+            elif dic.get("stream", False):
+                stream_cmd(dic, timeout=timeout, progress=self._write_progress)
+            else:
+                execute_cmd(dic, timeout=timeout)
+            self._add_result(dic)
+
+    def _write_progress(self, dic):
+        res = get_database().post("_bulk_docs", params=dict(docs=[dic])).json()
+        if len(res) > 0 and "rev" in res[0]:
+            dic["_rev"] = res[0]["rev"]
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._flush_now.wait(self._flush_interval)
+            self._flush_now.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write finished results back to the database
+        """
+        with self._lock:
+            batch, self._results = self._results, []
+        if len(batch) == 0: return
+        try:
+            get_database().post("_bulk_docs", params=dict(docs=batch))
+        except:
+            logging.exception("Error writing command results")
+            # Try again at the next flush
+            with self._lock:
+                self._results[:0] = batch
+            return
+        with self._lock:
+            for dic in batch:
+                self._in_flight.discard(dic["_id"])
+
+    def stop(self, timeout=None):
+        """
+        Stop the executor, waiting for running commands and writing back the
+        results.  Commands that have not yet started are not run.
+        """
+        while True:
+            try:
+                dic = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            dic["ret"] = [None, "Not run, daemon stopped"]
+            self._add_result(dic)
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join(timeout)
+        self._stopped = True
+        self._flush_now.set()
+        self._flusher.join(timeout)
+        self.flush()
 
 
 def broadcast_message(server_name="", send_data=None, timeout=10):
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import logging
+
+"""
+  Content-addressed store of module sources.
+
+  Sources are stored by their hash, in memory and, if a store directory is
+  set, on disk (<hash>.py) so that they survive restarts of the daemon.  Code
+  maps (see :func:`himbeerecouch.database.get_processes_code`) only hold the
+  hashes of their modules; the sources are looked up when a module is
+  compiled or imported.  Child processes inherit the in-memory store and
+  read sources added later from disk.
+"""
+
+_memory_store = {}
+_store_dir = None
+
+def set_store_dir(path):
+    """
+    Set directory where sources are stored, None disables the disk store
+
+    :param path: path to directory, created if it doesn't exist
+    :type path: str
+    """
+    global _store_dir
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+    _store_dir = path
+
+def source_hash(source):
+    """
+    :returns: str - hash of a module source
+    """
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    return hashlib.sha1(source).hexdigest()
+
+def _store_file(h):
+    return os.path.join(_store_dir, h + ".py")
+
+def put(source):
+    """
+    Add a source to the store
+
+    :param source: python code
+    :type source: str
+    :returns: str - hash of the source
+    """
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    h = source_hash(source)
+    _memory_store[h] = source
+    if _store_dir is not None and not os.path.exists(_store_file(h)):
+        tmp_path = _store_file(h) + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(source)
+            os.rename(tmp_path, _store_file(h))
+        except (IOError, OSError):
+            logging.exception("Error storing module source")
+    return h
+
+def get(h):
+    """
+    Get a source from the store
+
+    :param h: hash of the source
+    :type h: str
+    :returns: str - python code, None if the source is not in the store
+    """
+    source = _memory_store.get(h)
+    if source is not None or _store_dir is None: return source
+    try:
+        with open(_store_file(h), "rb") as f:
+            source = f.read()
+    except IOError:
+        return None
+    if source_hash(source) != h: return None
+    _memory_store[h] = source
+    return source
+
+def resolve(code, missing_ok=False):
+    """
+    Get the sources of a code map
+
+    :param code: dictionary of module hashes, by module name
+    :type code: dict
+    :param missing_ok: if True, modules missing in the store are left out,
+                       otherwise a KeyError is raised
+    :type missing_ok: bool
+    :returns: dict - dictionary of sources, by module name
+    """
+    ret = {}
+    for name, h in code.items():
+        source = get(h)
+        if source is not None:
+            ret[name] = source
+        elif not missing_ok:
+            raise KeyError("Source of module {} ({}) not in store".format(name, h))
+    return ret
+
+def prune(hashes):
+    """
+    Remove all sources not in hashes from the store
+    """
+    keep = set(hashes)
+    for h in _memory_store.keys():
+        if h not in keep: del _memory_store[h]
+    if _store_dir is None: return
+    for fn in os.listdir(_store_dir):
+        h, ext = os.path.splitext(fn)
+        if ext == ".py" and h not in keep:
+            try:
+                os.remove(os.path.join(_store_dir, fn))
+            except OSError: pass
@@ -0,0 +1,141 @@
+import sys
+import time
+import threading
+import collections
+
+"""
+  Low-overhead sampling profiler.
+
+  A background thread periodically samples the stacks of all other threads
+  (using sys._current_frames) and counts identical stacks.  The result is
+  returned in the "collapsed stacks" format used by flame graph tools
+  (e.g. flamegraph.pl), one line per stack:
+
+      thread;outer_function;...;inner_function count
+"""
+
+def _frame_name(frame):
+    co = frame.f_code
+    return "{} ({}:{})".format(co.co_name, co.co_filename, co.co_firstlineno)
+
+def collapse_stack(frame):
+    """
+    :returns: str - stack of frame (outermost first) separated by ';'
+    """
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of all threads of the current process.
+
+    :param interval: time (s) between samples
+    :type interval: float
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self._counts = collections.defaultdict(int)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, duration=None):
+        """
+        Start sampling, for at most duration seconds (None samples until
+        :meth:`stop` is called)
+        """
+        if self._thread is not None: return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(duration,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, duration):
+        own_id = threading.current_thread().ident
+        names = {}
+        end_time = None
+        if duration is not None: end_time = time.time() + duration
+        while not self._stop.is_set():
+            if end_time is not None and time.time() > end_time: break
+            for tid, frame in sys._current_frames().items():
+                if tid == own_id: continue
+                if tid not in names:
+                    names = dict((t.ident, t.name) for t in threading.enumerate())
+                # After a fork, frames of threads of the parent may remain
+                if tid not in names: continue
+                stack = collapse_stack(frame)
+                self._counts["{};{}".format(names[tid], stack)] += 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self):
+        """
+        Wait until sampling is finished
+        """
+        if self._thread is not None: self._thread.join()
+
+    def stop(self):
+        """
+        Stop sampling
+
+        :returns: str - collapsed stacks, see :meth:`collapsed`
+        """
+        self._stop.set()
+        self.wait()
+        self._thread = None
+        return self.collapsed()
+
+    def collapsed(self):
+        """
+        :returns: str - sampled stacks in the collapsed stacks format
+        """
+        return "\n".join("{} {}".format(k, v)
+                         for k, v in sorted(self._counts.items()))
+
+
+_profiler = None
+
+def start_profile(interval=0.005):
+    """
+    Start profiling the current process, see :func:`stop_profile`
+    """
+    global _profiler
+    if _profiler is not None and _profiler.running(): return False
+    _profiler = SamplingProfiler(interval)
+    _profiler.start()
+    return True
+
+def stop_profile():
+    """
+    Stop profiling started by :func:`start_profile`
+
+    :returns: str - collapsed stacks, None if no profile was running
+    """
+    global _profiler
+    if _profiler is None: return None
+    ret = _profiler.stop()
+    _profiler = None
+    return ret
+
+def profile(duration=10.0, interval=0.005):
+    """
+    Profile the current process for duration seconds
+
+    :param duration: time (s) to profile
+    :type duration: float
+    :param interval: time (s) between samples
+    :type interval: float
+    :returns: str - collapsed stacks
+    """
+    p = SamplingProfiler(interval)
+    p.start(duration)
+    p.wait()
+    return p.collapsed()
@@ -3,21 +3,50 @@ import signal
 import threading as _th
 import time
 import os
+import base64
 from .daemon import Daemon, ForceRestart
-from .util import getmacid, getpassword, getipaddr
+from .util import (getmacid,
+                   getpassword,
+                   getipaddr,
+                   read_json_file,
+                   write_json_file,
+                   backoff_delay)
 from .log import (MPLogHandler,
                   log,
                   start_child_logging,
-                  stop_child_logging)
-from .database import set_server, get_database, get_processes_code, send_heartbeat
-from .rpc import RaspServerProcess, start_new_process
-from .misc import execute_cmd, receive_broadcast_message
-import Queue
+                  stop_child_logging,
+                  child_logging_stats,
+                  add_log_sink,
+                  remove_log_sink,
+                  LogRingBuffer)
+from .database import (set_server,
+                       get_database,
+                       get_processes_code,
+                       Heartbeat,
+                       reset_acct,
+                       connection_stats,
+                       set_code_docs_file,
+                       prune_modules)
+from .rpc import RaspServerProcess, start_new_process, prewarm
+from .supervisor import ChildSupervisor
+from .telemetry import TelemetrySampler, TelemetrySeries
+from .logsink import CouchDBLogSink
+from . import codecache
+from . import datawriter
+from . import channel
+from . import modstore
+from .misc import CommandExecutor, receive_broadcast_message
 import logging
 
 
 _handled_signals = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]
 
+# Heartbeat interval of the changes feed (ms)
+_feed_heartbeat = 2000
+
+# Time (s) a new child process may take to register with the RPC server
+_registration_timeout = 60
+
 class ShouldExit(Exception):
     """
     Raised when exit is requested
@@ -33,6 +62,9 @@ class IDCache(object):
         self._lock = _th.Lock()
         self._ids = set()
         self._running_ids = set()
+        self._process_stats = {}
+        self._reconcile = _th.Event()
+        self.waker = None
 
     @property
     def ids(self):
@@ -52,7 +84,6 @@ class IDCache(object):
     def ids(self, ids):
         self._lock.acquire()
         self._ids = set(ids)
-        self._running_ids = set(ids)
         self._lock.release()
 
     @running_ids.setter
@@ -61,58 +92,207 @@ class IDCache(object):
         self._running_ids = set(ids)
         self._lock.release()
 
+    @property
+    def process_stats(self):
+        self._lock.acquire()
+        stats = self._process_stats
+        self._lock.release()
+        return stats
+
+    @process_stats.setter
+    def process_stats(self, stats):
+        self._lock.acquire()
+        self._process_stats = stats
+        self._lock.release()
+
     def __contains__(self, anid):
         self._lock.acquire()
         isin = anid in self._ids
         self._lock.release()
         return isin
 
+    def request_reconcile(self):
+        """
+        Request that the running processes are reconciled with the code in the
+        database, see :meth:`RaspberryDaemon.reconcile`
+        """
+        self._reconcile.set()
+        waker = self.waker
+        if waker is not None: waker()
+
+    def reconcile_requested(self):
+        """
+        Returns True (and resets the request) if a reconcile was requested
+        """
+        if not self._reconcile.is_set(): return False
+        self._reconcile.clear()
+        return True
+
+
+class FeedState(object):
+    """
+    Keeps track of the last sequence processed in the changes feed.  If
+    state_file is given, the sequence is persisted so that a restarted daemon
+    resumes where it left off.
+
+    :param state_file: path to state file
+    :type state_file: str
+    """
+    def __init__(self, state_file=None):
+        self._state_file = state_file
+        self._state = {}
+        if state_file is not None:
+            self._state = read_json_file(state_file, {})
+
+    @property
+    def last_seq(self):
+        return self._state.get("last_seq", "now")
 
-def listen_daemon(ids, daemon):
+    @last_seq.setter
+    def last_seq(self, seq):
+        self._state["last_seq"] = seq
+        if self._state_file is None: return
+        try:
+            write_json_file(self._state_file, self._state)
+        except:
+            logging.exception("Error writing state file")
+
+
+class CodeFetcher(object):
+    """
+    Fetches the code from the database (:func:`get_processes_code`) in a
+    background thread, retrying with a backoff until the server is
+    reachable.  When the code has been fetched, waker is called and the code
+    is available from :meth:`result`.
+
+    :param waker: function called when a result is available
+    :type waker: function
+    :param should_quit: function returning True when fetching should stop
+    :type should_quit: function
+    :param fetch: function returning the code, default :func:`get_processes_code`
+    :type fetch: function
+    """
+    def __init__(self, waker, should_quit, fetch=get_processes_code):
+        self._fetch_code = fetch
+        self._waker = waker
+        self._should_quit = should_quit
+        self._lock = _th.Lock()
+        self._thread = None
+        self._again = False
+        self._result = None
+
+    def request(self):
+        """
+        Request fetching the code, if a fetch is already running the code is
+        fetched again once it has finished.
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._again = True
+                return
+            self._thread = _th.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def result(self):
+        """
+        :returns: dict - the fetched code (see :func:`get_processes_code`), or
+                  None if no new result is available
+        """
+        with self._lock:
+            res, self._result = self._result, None
+        return res
+
+    def _fetch(self):
+        attempt = 0
+        while not self._should_quit():
+            try:
+                return self._fetch_code()
+            except:
+                logging.exception("Error fetching code")
+            end_time = time.time() + backoff_delay(attempt, base=1.0)
+            attempt += 1
+            while time.time() < end_time and not self._should_quit():
+                time.sleep(0.2)
+        return None
+
+    def _run(self):
+        while True:
+            code_list = self._fetch()
+            with self._lock:
+                if code_list is not None: self._result = code_list
+                if not self._again or self._should_quit():
+                    self._thread = None
+                    break
+                self._again = False
+            self._waker()
+        self._waker()
+
+
+def listen_daemon(ids, daemon, executor):
     """
-    Listen for changes in code in the database.
+    Listen for changes in code in the database.  Command documents are passed
+    to executor (:class:`himbeerecouch.misc.CommandExecutor`).
+
+    The feed resumes from the last processed sequence (see :class:`FeedState`)
+    and reconnects with an exponential backoff on errors.
     """
+    feed_state = daemon.feed_state
+    heartbeat = daemon.heartbeat
+    attempt = 0
     while 1:
         try:
             adb = get_database()
             mi = str(getmacid())
             ch = adb.changes(params=dict(feed='continuous',
-                                         heartbeat=2000,
+                                         heartbeat=_feed_heartbeat,
                                          include_docs=True,
-                                         since='now',
+                                         since=feed_state.last_seq,
                                          filter='nedm_default/doc_type',
                                          type=[mi, mi+"_cmd"],
                                          handle_deleted=True),
                                          emit_heartbeats=True)
             ip_addr = getipaddr()
             for l in ch:
+                attempt = 0
                 if l is None and daemon.should_quit(): raise ShouldExit()
                 if l is None:
                     # Take care of housekeeping on the heartbeats
-                    send_heartbeat(db=adb,running_ids=list(ids.running_ids), ip=ip_addr)
+                    heartbeat.update(running_ids=sorted(ids.running_ids), ip=ip_addr)
+                    heartbeat.set_stats(processes=ids.process_stats,
+                                        connections=connection_stats(),
+                                        logging=child_logging_stats())
+                    if daemon.sink is not None:
+                        heartbeat.set_stats(log_sink=daemon.sink.stats())
+                    heartbeat.tick(adb)
                     continue
-                # Force reload
+                # Only the processes whose code changed will be restarted
                 if "deleted" in l:
-                    if l['id'] in ids: raise ReloadDaemon()
+                    if l['id'] in ids: ids.request_reconcile()
                 else:
                     # See if it's a cmd doc
                     t = l["doc"]
                     if t['type'] == mi + '_cmd':
-                         if "ret" in t: continue
-                         execute_cmd(t)
-                         adb.post("_bulk_docs", params=dict(docs=[t]))
+                         # Skip finished commands or those in progress
+                         if "ret" not in t and "progress" not in t:
+                             executor.submit(t)
                     else:
-                         raise ReloadDaemon()
-        except ReloadDaemon:
-            log("Forcing a restart, because new document arrived/got deleted")
-            daemon.reload(True)
-            return
+                         ids.request_reconcile()
+                if "seq" in l: feed_state.last_seq = l["seq"]
         except ShouldExit:
             return
         except:
             logging.exception("Error in changes feed thread")
             if daemon.should_quit(): return
-            time.sleep(5)
+            # Force a new session on the next connection
+            reset_acct()
+            delay = backoff_delay(attempt)
+            attempt += 1
+            log("Reconnecting to changes feed in {:.1f} s".format(delay))
+            end_time = time.time() + delay
+            while time.time() < end_time:
+                if daemon.should_quit(): return
+                time.sleep(min(0.2, max(end_time - time.time(), 0)))
 
 class ListenDaemon(object):
     """
@@ -128,34 +308,110 @@ class ListenDaemon(object):
         self.ids = ids
         self.daemon = daemon
         self.t = None
+        self.executor = None
         # start logging of children
         start_child_logging()
 
     def __enter__(self):
-        self.t = _th.Thread(target=listen_daemon, args=(self.ids,self.daemon))
+        self.executor = CommandExecutor(handlers=self.daemon.command_handlers())
+        self.t = _th.Thread(target=listen_daemon,
+                            args=(self.ids,self.daemon,self.executor))
         self.t.start()
 
     def __exit__(self, *args):
         self.t.join()
+        self.executor.stop(timeout=5)
         # stop logging of children
         stop_child_logging()
 
 class RaspberryDaemon(Daemon):
-    def __init__(self, pid_file, server_file="", **kwargs):
+    """
+    Daemon running the code from the database.
+
+    :param pid_file: path to pid file
+    :type pid_file: str
+    :param server_file: path to file containing server name
+    :type server_file: str
+    :param state_dir: directory where state (e.g. last sequence of the changes
+                      feed) is persisted, if None state is only kept in memory
+    :type state_dir: str
+    :param zygote: if True, modules needed by the children are imported in the
+                   daemon before forking, see :func:`himbeerecouch.rpc.prewarm`
+    :type zygote: bool
+    :param heartbeat_interval: interval (s) of keep-alive writes of the
+                               heartbeat document when nothing changes, see
+                               :class:`himbeerecouch.database.Heartbeat`
+    :type heartbeat_interval: float
+    :param telemetry_interval: interval (s) of sampling the resource usage of
+                               the child processes
+    :type telemetry_interval: float
+    :param telemetry_series: if True, all telemetry samples are written to
+                             the database, see
+                             :class:`himbeerecouch.telemetry.TelemetrySeries`
+    :type telemetry_series: bool
+    :param log_sink: if True, log records are also written to the database,
+                     see :class:`himbeerecouch.logsink.CouchDBLogSink`
+    :type log_sink: bool
+    :param log_database: name of the database the log records are written
+                         to, default is the database of the raspberries
+    :type log_database: str
+    :param recent_logs: number of log records kept in memory for each process,
+                        see :class:`himbeerecouch.log.LogRingBuffer`
+    :type recent_logs: int
+    """
+    def __init__(self, pid_file, server_file="", state_dir=None, zygote=True,
+                 heartbeat_interval=60.0, telemetry_interval=5.0,
+                 telemetry_series=False, log_sink=False, log_database=None,
+                 recent_logs=2000, **kwargs):
         Daemon.__init__(self, pid_file, **kwargs)
         self.server_file = server_file
+        self.state_dir = state_dir
+        self.zygote = zygote
+        self.heartbeat = Heartbeat(keepalive_interval=heartbeat_interval)
+        self.telemetry_interval = telemetry_interval
+        self.telemetry_series = None
+        if telemetry_series:
+            self.telemetry_series = TelemetrySeries()
         self._should_quit = False
         self._is_reloading = False
+        state_file = None
+        self.code_cache_file = None
+        if state_dir is not None:
+            state_file = os.path.join(state_dir, 'rspby_daemon.state')
+            self.code_cache_file = os.path.join(state_dir, 'rspby_code.json')
+            codecache.set_cache_dir(os.path.join(state_dir, 'bytecode'))
+            modstore.set_store_dir(os.path.join(state_dir, 'modules'))
+            set_code_docs_file(os.path.join(state_dir, 'rspby_docs.json'))
+            datawriter.set_spool_dir(os.path.join(state_dir, 'spool'))
+        self.feed_state = FeedState(state_file)
+        self.log_sink = log_sink
+        self.log_database = log_database
+        self.log_spool_file = None
+        self.imports_file = None
+        self.runtime_imports = {}
+        self.sink = None
+        self.recent_logs = LogRingBuffer(recent_logs)
+        if state_dir is not None:
+            self.log_spool_file = os.path.join(state_dir, 'rspby_log_spool.json')
+            self.imports_file = os.path.join(state_dir, 'rspby_imports.json')
+            self.runtime_imports = read_json_file(self.imports_file, {})
 
     def should_quit(self):
         return self._should_quit
 
-    def run_as_daemon(self, ids):
+    def start_processes(self, code_list):
+        """
+        Start processes for the given code, adding them to the supervisor
 
-        serv = RaspServerProcess()
-
-        code_list = get_processes_code()
-        processes = {}
+        :param code_list: code, as returned by :func:`get_processes_code`
+        :type code_list: dict
+        """
+        # Compile once, children inherit the compiled modules
+        codecache.precompile(code_list)
+        if self.zygote:
+            preload = set()
+            for o in code_list.values(): preload.update(o.get("preload", []))
+            prewarm(preload)
 
         # Ignore handlers when starting new processes
         sig_hdlrs = {}
@@ -164,44 +420,382 @@ class RaspberryDaemon(Daemon):
             signal.signal(s, signal.SIG_IGN)
 
         for aname, o in code_list.items():
-            processes[o["id"]] = start_new_process(aname, o["code"])
-
+            t, conn = start_new_process(aname, o["code"], o.get("limits"))
+            self.supervisor.add(o["id"], aname, t, conn, o.get("limits"))
 
         # Reset handlers
         for s in sig_hdlrs:
             signal.signal(s, sig_hdlrs[s])
 
-        ids.ids = processes.keys()
+    def stop_processes(self, serv, anids, timeout=20):
+        """
+        Request the processes with the given ids to exit, those that do not
+        exit within timeout seconds are killed (see :meth:`check_requests`).
+        When they have exited, they are started again with their current
+        code (see :meth:`process_exited`).  Returns immediately.
+        """
+        self.request_exit(serv, anids)
+        for anid in anids:
+            self._stopping[anid] = time.time() + timeout
+
+    def request_exit(self, serv, anids, timeout=5):
+        """
+        Request the processes with the given ids to exit (RPC call "exit").
+        Processes that have not yet registered with the RPC server have not
+        started running their code (and don't handle SIGTERM yet), these are
+        killed.  Processes that do not answer the request within timeout
+        seconds are sent SIGTERM (see :meth:`check_requests`).  Returns
+        immediately.
+        """
+        pids = {}
+        for anid in anids:
+            rec = self.supervisor.get(anid)
+            if serv.registration_time(rec.pid) is None:
+                log("Process ({}) not yet registered, terminating".format(anid))
+                os.kill(rec.pid, signal.SIGKILL)
+            else:
+                pids[rec.name] = rec.pid
+        if len(pids) == 0: return
+        self._exit_calls.append(
+          (serv.call_async("exit", target=pids.keys(), timeout=timeout), pids))
+
+    def check_requests(self, serv):
+        """
+        Handle the answers to exit and reload requests that arrived (see
+        :meth:`request_exit` and :meth:`hot_reload`) and kill the processes
+        that did not stop in time.  This doesn't wait for any process, it is
+        called regularly by the supervision loop.
+        """
+        pids = set(self.supervisor.get(anid).pid for anid in self.supervisor.ids())
+        for call in [c for c in self._exit_calls if c[0].done()]:
+            self._exit_calls.remove(call)
+            future, names = call
+            results = future.results(wait=False)
+            serv.finish_call(future)
+            for name, res in results.items():
+                if res is True or names[name] not in pids: continue
+                log("Process ({}) did not answer exit request, terminating: {}".format(name,
+                  repr(res)))
+                try:
+                    os.kill(names[name], signal.SIGTERM)
+                except OSError: pass
+
+        for call in [c for c in self._reload_calls if c[3].done()]:
+            self._reload_calls.remove(call)
+            anid, aname, pid, future = call
+            res = future.results(wait=False).get(aname)
+            serv.finish_call(future)
+            if isinstance(res, list):
+                log("Reloaded modules of {}: {}".format(aname, res))
+            elif pid in pids:
+                log("Reloading {} failed, restarting: {}".format(aname, repr(res)))
+                self.stop_processes(serv, [anid])
+
+        now = time.time()
+        for anid, deadline in self._stopping.items():
+            if deadline is None or now < deadline or anid not in self.supervisor: continue
+            log("Time out waiting for process ({}), force terminate".format(anid))
+            os.kill(self.supervisor.get(anid).pid, signal.SIGKILL)
+            self._stopping[anid] = None
+
+    def process_exited(self, anid):
+        """
+        Called when the process with id anid has exited, processes stopped by
+        :meth:`stop_processes` are started again with their current code
+        (unless the daemon is quitting or the code was removed).
+        """
+        if anid not in self._stopping: return
+        del self._stopping[anid]
+        o = self._code.get(anid)
+        if o is None or anid in self.supervisor or self.should_quit(): return
+        log("Starting processes: {}".format([o["name"]]))
+        self.start_processes({ o["name"] : o })
+
+    def reconcile(self, serv, ids, code_list):
+        """
+        Compare code_list (as returned by :func:`get_processes_code`) with the
+        code of the running processes, and restart only those processes whose
+        document (revision or name), code or resource limits changed.
+        Processes that are no longer running are started again.  Processes
+        with unchanged code are not touched, processes with "hot_reload" get
+        their changed code reloaded (see :meth:`hot_reload`) and are only
+        restarted if that fails.  Changed processes are started again once
+        the old process has exited, see :meth:`stop_processes`.
+        """
+        new_code = dict((o["id"], dict(o, name=aname)) for aname, o in code_list.items())
+        old_code = self._code
+
+        def _changed(old, new):
+            return any(old.get(k) != new.get(k) for k in ["rev", "name", "digest"]) or \
+                   old.get("limits", {}) != new.get("limits", {})
+
+        to_stop = [anid for anid in old_code
+                     if anid not in new_code or _changed(old_code[anid], new_code[anid])]
+        reloading = self.hot_reload(serv,
+                      dict((o["id"], (aname, o)) for aname, o in code_list.items()
+                             if o["id"] in to_stop))
+        running = [anid for anid in to_stop
+                     if anid not in reloading and anid in self.supervisor and
+                        anid not in self._stopping]
+        # New processes and processes that exited (normally or not), running
+        # processes are started when they have exited
+        to_start = dict((aname, o) for aname, o in code_list.items()
+                          if o["id"] not in self.supervisor)
+
+        if len(running) > 0:
+            log("Stopping changed processes: {}".format(running))
+            self.stop_processes(serv, running)
+        if len(to_start) > 0:
+            log("Starting processes: {}".format(to_start.keys()))
+            self.start_processes(to_start)
+
+        self._code = new_code
+        ids.ids = new_code.keys()
+        self.update_running(ids)
+        codecache.prune(code_list)
+        prune_modules()
+
+    def hot_reload(self, serv, changed, timeout=10):
+        """
+        Request reloading the code of running processes whose old and new
+        code both have "hot_reload" set and whose limits did not change.  The
+        new code is sent to the process (RPC call "reload_code", see
+        :meth:`himbeerecouch.rpc.ProcessImporter.reload_modules`), processes
+        for which this fails are restarted when the answer arrives (see
+        :meth:`check_requests`).  Returns immediately.
+
+        :param changed: changed code, (name, code) by document id
+        :type changed: dict
+        :returns: list - ids of the processes that are reloaded
+        """
+        reloading = []
+        for anid, (aname, o) in changed.items():
+            if anid not in self.supervisor or anid in self._stopping: continue
+            old = self._code[anid]
+            rec = self.supervisor.get(anid)
+            if (rec.name != aname or
+                not old.get("hot_reload") or not o.get("hot_reload") or
+                old.get("limits", {}) != o.get("limits", {}) or
+                serv.registration_time(rec.pid) is None): continue
+            codecache.precompile({ aname : o })
+            # The process only has the sources that existed when it started
+            sources = [modstore.get(h) for h in
+                         set(o["code"].values()) - set(old["code"].values())]
+            self._reload_calls.append((anid, aname, rec.pid,
+              serv.call_async("reload_code", args=(o["code"], sources),
+                              target=aname, timeout=timeout)))
+            reloading.append(anid)
+        return reloading
+
+    def record_imports(self, anid, names):
+        """
+        Record modules imported at runtime by the code with id anid, they are
+        passed to :func:`get_processes_code`
+
+        :returns: bool - True if new modules were recorded
+        """
+        known = set(self.runtime_imports.get(anid, []))
+        if known.issuperset(names): return False
+        self.runtime_imports[anid] = sorted(known.union(names))
+        if self.imports_file is not None:
+            try:
+                write_json_file(self.imports_file, self.runtime_imports)
+            except:
+                logging.exception("Error writing runtime imports")
+        return True
+
+    def save_code_cache(self, code_list):
+        """
+        Save the code locally, it is used at the next start before the
+        server is reachable.
+        """
+        if self.code_cache_file is None: return
+        try:
+            write_json_file(self.code_cache_file, code_list)
+        except:
+            logging.exception("Error writing code cache")
+
+    def update_running(self, ids):
+        ids.running_ids = self.supervisor.ids()
+        ids.process_stats = self.supervisor.stats()
+
+    def command_handlers(self):
+        """
+        :returns: dict - handlers of command documents run by the daemon, see
+                  :class:`himbeerecouch.misc.CommandExecutor`
+        """
+        return { "profile" : self.profile_processes,
+                 "logs" : self.query_logs }
+
+    def query_logs(self, dic, timeout):
+        """
+        Handle a logs command document, which looks like::
+
+            {
+              "type" : "MacID_cmd",
+              "logs" : {
+                "name" : "name of code", # optional, default all
+                "level" : "WARNING",     # optional, minimum level
+                "limit" : 100            # optional, number of records
+              }
+            }
+
+        "ret" contains the most recent records (oldest first), see
+        :meth:`himbeerecouch.log.LogRingBuffer.query`
+        """
+        opts = dic["logs"]
+        if not isinstance(opts, dict): opts = {}
+        dic["ret"] = [self.recent_logs.query(name=opts.get("name"),
+                                             level=opts.get("level"),
+                                             limit=int(opts.get("limit", 100))),
+                      None]
+
+    def profile_processes(self, dic, timeout):
+        """
+        Handle a profile command document, which looks like::
+
+            {
+              "type" : "MacID_cmd",
+              "profile" : {
+                "name" : "name of code", # optional, default all
+                "duration" : 10,         # optional, time (s) to profile
+                "interval" : 0.005       # optional, time (s) between samples
+              }
+            }
+
+        The profiles (in the collapsed stacks format, see
+        :mod:`himbeerecouch.profiler`) are saved as attachments
+        "profile-<name>.txt", "ret" contains the number of stacks per process.
+        """
+        opts = dic["profile"]
+        duration = float(opts.get("duration", 10.0))
+        future = self.rpc_server.call_async("profile",
+                   kwargs=dict(duration=duration,
+                               interval=float(opts.get("interval", 0.005))),
+                   target=opts.get("name"),
+                   timeout=min(duration + 10, timeout))
+        results = future.results()
+        self.rpc_server.finish_call(future)
+        summary = {}
+        for name, res in results.items():
+            if not isinstance(res, basestring):
+                summary[name] = repr(res)
+                continue
+            summary[name] = "{} stacks".format(len(res.splitlines()))
+            dic.setdefault("_attachments", {})["profile-{}.txt".format(name)] = {
+              "content_type" : "text/plain",
+              "data" : base64.b64encode(res)
+            }
+        dic["ret"] = [summary, None]
 
-        serv.accept_connection(len(processes))
+    def run_as_daemon(self, ids):
+
+        serv = RaspServerProcess()
+        serv.start_accepting()
+        self.rpc_server = serv
+
+        self._code = {}
+        self._stopping = {}
+        self._exit_calls = []
+        self._reload_calls = []
+        self.supervisor = ChildSupervisor()
+        ids.waker = self.supervisor.wake
+        sink = None
+        if self.log_sink:
+            sink = CouchDBLogSink(self.log_database,
+                                  spool_file=self.log_spool_file)
+            add_log_sink(sink)
+        self.sink = sink
+        add_log_sink(self.recent_logs)
+        # Shared memory of the local channels of the children
+        channel.create_channel_dir()
+        try:
+            self.supervise(serv, ids)
+        finally:
+            ids.waker = None
+            self.supervisor.close()
+            serv.close()
+            remove_log_sink(self.recent_logs)
+            channel.remove_channel_dir()
+            if sink is not None:
+                remove_log_sink(sink)
+                sink.close()
+
+    def supervise(self, serv, ids):
+        # Start immediately with the last known code, it is reconciled with
+        # the database as soon as the server is reachable.
+        if self.code_cache_file is not None:
+            code_list = read_json_file(self.code_cache_file)
+            if code_list is not None:
+                log("Starting from local code cache")
+                self.reconcile(serv, ids, code_list)
+
+        fetcher = CodeFetcher(self.supervisor.wake, self.should_quit,
+                     lambda: get_processes_code(self.runtime_imports))
+        fetcher.request()
 
         exit_req = False
         exit_time = None
+        sampler = TelemetrySampler()
+        next_sample = 0
+        retry_reconcile = None
 
         with ListenDaemon(ids, self):
-            while len(processes) > 0:
-                del_list = []
-                for anid,x in processes.items():
-                    t,q = x
+            while len(self.supervisor) > 0 or not exit_req:
+                if retry_reconcile is not None and time.time() > retry_reconcile:
+                    retry_reconcile = None
+                    ids.request_reconcile()
+                if ids.reconcile_requested(): fetcher.request()
+                code_list = fetcher.result()
+                if code_list is not None and not exit_req:
+                    self.save_code_cache(code_list)
                     try:
-                        res = q.get(True,0.2)
-                        t.join()
-                        if "ok" not in res:
-                            log("Error seen ({}) : {}".format(anid, res["error"]))
-                        del_list.append(anid)
-                    except (Queue.Empty,IOError):
-                        pass
-                    if self.should_quit() and not exit_req:
-                        serv.exit()
-                        exit_req = True
-                        exit_time = time.time()
-
-                for t in del_list: del processes[t]
-                ids.running_ids = processes.keys()
+                        self.reconcile(serv, ids, code_list)
+                    except:
+                        logging.exception("Error reconciling processes")
+                        # Try again later
+                        retry_reconcile = time.time() + 5
+
+                for anid, rec, res in self.supervisor.wait(1.0):
+                    if "ok" not in res:
+                        log("Error seen ({}) : {}".format(anid, res["error"]))
+                    if self.record_imports(anid, res.get("missing_modules", [])):
+                        # The module may be a global module it didn't get
+                        ids.request_reconcile()
+                    serv.remove_client(rec.pid)
+                    sampler.forget(rec.pid)
+                    self.process_exited(anid)
+                self.check_requests(serv)
+                for anid, rec in self.supervisor.check_registration(
+                                   serv.registration_time, _registration_timeout):
+                    log("Process ({}) did not register in time, terminating".format(anid))
+                    os.kill(rec.pid, signal.SIGKILL)
+                if time.time() > next_sample:
+                    next_sample = time.time() + self.telemetry_interval
+                    samples = self.supervisor.sample_telemetry(sampler)
+                    if self.telemetry_series is not None:
+                        self.telemetry_series.add(samples)
+                    for anid, rec, limit, value in self.supervisor.check_limits():
+                        log("Process ({}) exceeded {} ({} > {})".format(anid,
+                          limit, value, rec.limits[limit]))
+                        if limit != "max_rss_mb" or exit_req: continue
+                        if rec.breaches[limit] == 1:
+                            log("Stopping process ({})".format(anid))
+                            self.request_exit(serv, [anid])
+                        else:
+                            log("Process ({}) did not stop, terminating".format(anid))
+                            os.kill(rec.pid, signal.SIGKILL)
+                self.update_running(ids)
+
+                if self.should_quit() and not exit_req:
+                    self.request_exit(serv, self.supervisor.ids())
+                    exit_req = True
+                    exit_time = time.time()
+
                 if exit_req and time.time() - exit_time > 20:
                     log("Time out waiting for processes, force terminate")
-                    for t in processes:
-                        os.kill(processes[t][0].pid, signal.SIGKILL)
+                    for anid in self.supervisor.ids():
+                        os.kill(self.supervisor.get(anid).pid, signal.SIGKILL)
                     log("Restart will be forced if not quitting")
                     raise ForceRestart()
 
@@ -259,7 +853,8 @@ def run_daemon(cmd, sf, apath):
     join = os.path.join
     daemon = RaspberryDaemon(join(apath, 'rspby_daemon.pid'),
                              stdout=join(apath, 'rspby_daemon.log'),
-                             server_file=sf)
+                             server_file=sf,
+                             state_dir=apath)
     if 'start' == cmd:
         daemon.start()
     elif 'stop' == cmd:
@@ -271,13 +866,16 @@ def run_daemon(cmd, sf, apath):
     else:
         print "usage: start|stop|restart|reload"
 
-def run(sf):
+def run(sf, apath=None):
     """
     Run daemon in blocking mode (e.g. with supervisord)
 
     :param sf: name of server file (path)
     :type sf: str 
+    :param apath: path to save state files, if None state is not persisted
+    :type apath: str 
     """
     daemon = RaspberryDaemon("/dev/null",
-                             server_file=sf)
+                             server_file=sf,
+                             state_dir=apath)
     daemon.run()
@@ -1,9 +1,18 @@
 from multiprocessing.connection import Listener, Client
 import multiprocessing as _mp
 from threading import Thread
+import threading
+import itertools
 from .log import log
 from .database import get_acct
-from .util import stack_trace
+from .util import stack_trace, apply_limits
+from .codecache import compile_module
+from . import modstore
+from .profiler import profile, start_profile, stop_profile
+from .datawriter import (data_writer, data_writer_stats,
+                         request_flush_data_writers, close_data_writers)
+from .channel import local_channel
+from .sampling import Sampler
 import traceback
 import string
 import random
@@ -11,6 +20,7 @@ import logging
 import os
 import signal
 import json
+import time
 
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
    """
@@ -36,20 +46,106 @@ class RPCObject(object):
 Complete""".format('\n   '.join(stack_trace(self.output_handler))))
 
 
+class RPCTimeout(Exception):
+    """
+    Result of a remote procedure call for a client that did not answer in time
+    """
+
+
+class RPCFuture(object):
+    """
+    Results of an asynchronous remote procedure call (see
+    :meth:`RPCServer.call_async`), collected as they arrive from the clients.
+
+    :param names: names of the clients called
+    :type names: list
+    :param timeout: time (s) to wait for the results
+    :type timeout: float
+    """
+    def __init__(self, names, timeout):
+        self._cond = threading.Condition()
+        self._results = {}
+        self._pending = set(names)
+        self._deadline = None
+        if timeout is not None:
+            self._deadline = time.time() + timeout
+
+    def _set_result(self, name, result):
+        with self._cond:
+            if name not in self._pending: return
+            self._pending.discard(name)
+            self._results[name] = result
+            self._cond.notify_all()
+
+    def done(self):
+        """
+        :returns: bool - True if all clients answered or the call timed out
+        """
+        with self._cond:
+            return (len(self._pending) == 0 or
+                    (self._deadline is not None and time.time() > self._deadline))
+
+    def wait(self):
+        """
+        Wait until all clients answered or the call timed out
+        """
+        with self._cond:
+            while len(self._pending) > 0:
+                if self._deadline is None:
+                    self._cond.wait(1.0)
+                    continue
+                remaining = self._deadline - time.time()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+
+    def results(self, wait=True):
+        """
+        :param wait: if True, wait for the call to finish (see :meth:`wait`)
+        :type wait: bool
+        :returns: dict - results keyed by client name, clients that did not
+                  answer (yet) have an :class:`RPCTimeout` as result.
+        """
+        if wait: self.wait()
+        with self._cond:
+            ret = dict(self._results)
+            for name in self._pending:
+                ret[name] = RPCTimeout("No answer from {}".format(name))
+        return ret
+
+
 class RPCServer(RPCObject):
     """
     RPC (Remote-Procedure-Call server)
 
-    Calls remote procedures on all child processes
+    Calls remote procedures on child processes.  A call is sent to all
+    (targeted) clients at once and the answers are collected as they arrive
+    by a reader thread per client, so that one slow client does not delay the
+    others.  Calling any method on this object, e.g.::
+
+        serv.exit()
+
+    calls it on all clients and waits (at most the default timeout) for the
+    results, see :meth:`call_async` for a non-blocking call.
     """
+    # Default time (s) to wait for answers from clients
+    timeout = 20
+
     def __init__(self, address, authkey):
         super(RPCServer, self).__init__()
         self._clients = {}
+        self._send_locks = {}
+        self._calls = {}
+        self._registered = {}
+        self._call_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._address = address
+        self._authkey = authkey
+        self._accept_thread = None
         self._server_c = Listener(address, authkey=authkey)
 
     def output_handler(self, sn, fr):
         super(RPCServer, self).output_handler(sn, fr)
-        for c in self._clients:
+        for c in self._clients.keys():
             try:
                 os.kill(self._clients[c]["pid"], signal.SIGUSR1)
             except: pass
@@ -58,20 +154,172 @@ class RPCServer(RPCObject):
         for x in range(connections):
            client_c = self._server_c.accept()
            client_name = json.loads(client_c.recv())
-           self._clients[client_c] = client_name
+           self._add_client(client_c, client_name)
+
+    def start_accepting(self):
+        """
+        Accept connections in a background thread, i.e. clients register
+        whenever they are ready (see :meth:`registration_time`).
+        """
+        if self._accept_thread is not None: return
+        self._accepting = True
+        self._accept_thread = Thread(target=self._accept_loop)
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+
+    def _accept_loop(self):
+        while self._accepting:
+            try:
+                client_c = self._server_c.accept()
+            except:
+                if not self._accepting: break
+                logging.exception("Error accepting RPC client")
+                continue
+            if not self._accepting:
+                client_c.close()
+                break
+            try:
+                if not client_c.poll(5): raise Exception("No registration received")
+                client_name = json.loads(client_c.recv())
+            except:
+                logging.exception("Error registering RPC client")
+                client_c.close()
+                continue
+            self._add_client(client_c, client_name)
+
+    def registration_time(self, pid):
+        """
+        :returns: float - time when the client with pid registered, or None
+                  if it has not registered (yet)
+        """
+        with self._lock:
+            return self._registered.get(pid)
+
+    def close(self):
+        """
+        Stop accepting clients and close all connections
+        """
+        if self._accept_thread is not None:
+            self._accepting = False
+            # Wake up the accepting thread
+            try:
+                Client(self._address, authkey=self._authkey).close()
+            except: pass
+            self._accept_thread.join(5)
+            self._accept_thread = None
+        self._server_c.close()
+        with self._lock:
+            conns = self._clients.keys()
+            self._clients = {}
+            self._send_locks = {}
+        for c in conns:
+            try:
+                c.close()
+            except: pass
+
+    def _add_client(self, client_c, client_name):
+        with self._lock:
+            self._clients[client_c] = client_name
+            # Calls may be sent from several threads at once
+            self._send_locks[client_c] = threading.Lock()
+            self._registered[client_name["pid"]] = time.time()
+        t = threading.Thread(target=self._read_client, args=(client_c,))
+        t.daemon = True
+        t.start()
+
+    def _read_client(self, client_c):
+        name = self._clients[client_c]["name"]
+        while True:
+            try:
+                call_id, result = client_c.recv()
+            except:
+                break
+            with self._lock:
+                future = self._calls.get(call_id)
+            if future is not None:
+                future._set_result(name, result)
+        # Fail all calls waiting on this client
+        with self._lock:
+            futures = self._calls.values()
+        for future in futures:
+            future._set_result(name, "Connection to {} closed".format(name))
+
+    def remove_client(self, pid):
+        """
+        Stop handling the client with a given pid, e.g. when the child process
+        has been stopped.
+        """
+        with self._lock:
+            conns = [c for c in self._clients if self._clients[c]["pid"] == pid]
+            for c in conns:
+                del self._clients[c]
+                self._send_locks.pop(c, None)
+            self._registered.pop(pid, None)
+        for c in conns:
+            try:
+                c.close()
+            except: pass
+
+    def client_names(self):
+        """
+        :returns: list - names of connected clients
+        """
+        with self._lock:
+            return [v["name"] for v in self._clients.values()]
+
+    def call_async(self, name, args=(), kwargs=None, target=None, timeout=None):
+        """
+        Call a remote procedure without waiting for the results.
+
+        :param name: name of the procedure
+        :type name: str
+        :param args: positional arguments
+        :type args: tuple
+        :param kwargs: keyword arguments
+        :type kwargs: dict
+        :param target: name (or list of names) of the clients to call, None
+                       calls all clients
+        :param timeout: time (s) to wait for answers, default :attr:`timeout`
+        :type timeout: float
+        :rtype: :class:`RPCFuture`
+        """
+        if kwargs is None: kwargs = {}
+        if timeout is None: timeout = self.timeout
+        if isinstance(target, basestring): target = [target]
+        with self._lock:
+            clients = [(c, v["name"], self._send_locks[c])
+                         for c, v in self._clients.items()
+                         if target is None or v["name"] in target]
+            # Forget calls that are finished
+            for k in [k for k, v in self._calls.items() if v.done()]:
+                del self._calls[k]
+            call_id = self._call_ids.next()
+            future = RPCFuture([n for _, n, _ in clients], timeout)
+            self._calls[call_id] = future
+        for c, client_name, send_lock in clients:
+            try:
+                with send_lock:
+                    c.send((call_id, name, args, kwargs))
+            except:
+                future._set_result(client_name, traceback.format_exc())
+        return future
+
+    def finish_call(self, future):
+        """
+        Stop collecting results for a call returned by :meth:`call_async`
+        """
+        with self._lock:
+            for k, v in self._calls.items():
+                if v is future: del self._calls[k]
 
     def __getattr__(self, name):
+        if name.startswith("_"): raise AttributeError(name)
         def do_rpc(*args, **kwargs):
-            results = {}
-            for c in self._clients:
-                client_name = self._clients[c]["name"]
-                try:
-                    c.send((name, args, kwargs))
-                    results[client_name] = c.recv()
-                except:
-                    results[client_name] = traceback.format_exc()
+            future = self.call_async(name, args, kwargs)
+            results = future.results()
+            self.finish_call(future)
             for _, v in results.items():
-                if isinstance(v, Exception):
+                if isinstance(v, Exception) and not isinstance(v, RPCTimeout):
                     raise v
             return results
         return do_rpc
@@ -86,28 +334,46 @@ class RPCProxy(RPCObject):
         super(RPCProxy, self).__init__()
         self._functions = { }
         self._quitnotifiers = set()
-        self._conn = Client(address, authkey=authkey)
-        self._conn.send(json.dumps({"name" : _mp.current_process().name, "pid" : os.getpid()}))
+        self._send_lock = threading.Lock()
         self._should_exit = False
         self.register_function(self.exit_now, "exit")
+        self.register_function(profile)
+        self.register_function(start_profile)
+        self.register_function(stop_profile)
+        self.register_function(data_writer_stats)
         def _exit(*args):
             self.exit_now()
+        # Handle signals before registering, the server relies on registered
+        # clients handling SIGTERM
         signal.signal(signal.SIGINT, _exit)
         signal.signal(signal.SIGTERM, _exit)
+        self._conn = Client(address, authkey=authkey)
+        self._conn.send(json.dumps({"name" : _mp.current_process().name, "pid" : os.getpid()}))
 
     def listen(self):
+        def handle_call(client_c, call_id, func_name, args, kwargs):
+            try:
+                r = self._functions[func_name](*args,**kwargs)
+            except Exception as e:
+                r = e
+            with self._send_lock:
+                try:
+                    client_c.send((call_id, r))
+                except: pass
+
         def handle_client(client_c):
             while not self._should_exit:
                 try:
-                    func_name, args, kwargs = client_c.recv()
+                    call_id, func_name, args, kwargs = client_c.recv()
                 except EOFError:
                     self.exit_now()
                     break
-                try:
-                    r = self._functions[func_name](*args,**kwargs)
-                    client_c.send(r)
-                except Exception as e:
-                    client_c.send(e)
+                # Handle each call in its own thread, so that long calls don't
+                # block e.g. exit requests
+                t = Thread(target=handle_call,
+                           args=(client_c, call_id, func_name, args, kwargs))
+                t.daemon = True
+                t.start()
         self.t = Thread(target=handle_client, args=(self._conn,))
         self.t.daemon = True
         self.t.start()
@@ -146,7 +412,10 @@ class RaspServerProcess(RPCServer):
 
 class ProcessImporter(object):
     """
-    Handles importing classes/modules from code in database.
+    Handles importing classes/modules from code in database.  modules maps
+    module names to the hashes of their sources, the sources are loaded from
+    the module store (see :mod:`himbeerecouch.modstore`) when the module is
+    first imported.
 
     See :func:`start_new_process` for an example of how this is used.
 
@@ -158,74 +427,178 @@ class ProcessImporter(object):
         else:
             self._exported_commands = exported_commands
         self._already_exported = []
+        self._missed = set()
 
     def find_module(self, fullname, path=None):
         if fullname in self._modules:
             return self
+        # Only top-level modules can be delivered by the database
+        if path is None: self._missed.add(fullname)
         return None
 
+    def missing_modules(self):
+        """
+        :returns: list - names of modules that could not be imported (i.e.
+                  not in the code and not importable otherwise)
+        """
+        import sys
+        return sorted(n for n in self._missed if sys.modules.get(n) is None)
+
     def load_module(self, name):
         import sys
         if name in sys.modules and name not in self._already_exported:
             return sys.modules[name]
         import imp
+        source = modstore.get(self._modules[name])
+        if source is None:
+            raise ImportError("Source of module {} not found".format(name))
         mod = imp.new_module(name)
-        exec self._modules[name] in mod.__dict__
+        exec compile_module(name, source) in mod.__dict__
         for cmd in self._exported_commands:
             mod.__dict__[cmd] = self._exported_commands[cmd]
         sys.modules[name] = mod
         self._already_exported.append(name)
         return mod
 
+    def reload_modules(self, modules, sources=None):
+        """
+        Replace the code with modules (dictionary of module hashes, the
+        sources not yet in the module store are passed in sources).  Changed
+        modules that are already imported are executed
+        again in place, i.e. in their existing module object, so that other
+        modules referencing them see the new code (code that is currently
+        running, e.g. the loop in ``main``, continues with the old code).
+        Afterwards, the ``on_reload(changed_modules)`` function of the main
+        module is called if it exists, it may e.g. migrate state.
+
+        Exceptions (e.g. syntax errors, errors in on_reload) are raised, the
+        process should then be restarted.
+
+        :returns: list - names of the changed modules
+        """
+        import sys
+        for source in sources or []:
+            modstore.put(source)
+        changed = sorted(n for n in modules if self._modules.get(n) != modules[n])
+        # Compile first, a syntax error leaves the old code in place
+        compiled = {}
+        for n in changed:
+            source = modstore.get(modules[n])
+            if source is None:
+                raise ImportError("Source of module {} not found".format(n))
+            compiled[n] = compile_module(n, source)
+        self._modules = modules
+        # Execute main last, it probably imports from the other modules
+        for n in sorted(changed, key=lambda n: n == "main"):
+            if n not in self._already_exported: continue
+            mod = sys.modules.get(n)
+            if mod is None: continue
+            exec compiled[n] in mod.__dict__
+        on_reload = getattr(sys.modules.get("main"), "on_reload", None)
+        if on_reload is not None:
+            on_reload(changed)
+        return changed
+
+
+# Modules every child process needs
+_child_modules = ["pynedm.log"]
+_preloaded = set()
+
+def prewarm(modules=None):
+    """
+    Import the modules needed by child processes in the current (supervisor)
+    process.  The supervisor then serves as a pre-initialised template
+    (zygote): children forked by :func:`start_new_process` inherit the
+    imported modules (as well as the compiled code cache, see
+    :func:`himbeerecouch.codecache.precompile`), so that starting a child
+    costs little more than a fork and running its ``main``.
+
+    :param modules: additional modules to import (e.g. "numpy")
+    :type modules: list
+    """
+    if modules is None: modules = []
+    for m in _child_modules + list(modules):
+        if m in _preloaded: continue
+        try:
+            __import__(m)
+        except:
+            logging.exception("Error preloading module ({})".format(m))
+        _preloaded.add(m)
+
 
-def start_new_process(name, code):
+def start_new_process(name, code, limits=None):
     """
       Start new child process
 
       :param name: Name of child process
       :type name: str
-      :param code: code to run, dictionary of modules (in string format)
+      :param code: code to run, dictionary of module hashes (see
+                   :mod:`himbeerecouch.modstore`)
       :type code: dict
-      :returns: (multiprocessing.Process, multiprocessing.Queue)
+      :param limits: resource limits applied to the child, see
+                     :func:`himbeerecouch.util.apply_limits`
+      :type limits: dict
+      :returns: (multiprocessing.Process, multiprocessing.Connection)
 
-      The Queue returned has the result returned from the child process::
+      The Connection returned (read end of a pipe) receives the result from
+      the child process::
 
-          { "ok" : True }
+          { "ok" : True, "time" : <time of exit> }
 
       when everything ok, and::
 
-          { "error" : ...traceback... }
+          { "error" : ...traceback..., "time" : <time of exit> }
 
-      when not.
+      when not.  "missing_modules" lists modules the code failed to import,
+      see :meth:`ProcessImporter.missing_modules`.  The pipe is closed when the child exits, so that waiting on
+      it also detects children that die without sending a result.
     """
     def _new_proc(q):
         import sys
+        if limits:
+            try:
+                apply_limits(limits)
+            except:
+                logging.exception("Error applying limits")
         # Use broadcaster from pynedm
         import pynedm.log as plog
         plog.use_broadcaster()
         o = RaspProxyProcess()
-        sys.meta_path.append(
-          ProcessImporter(code,
-            {
-            "log" : log,
-            "get_acct" : get_acct,
-            "should_quit" : o.should_exit,
-            "register_quit_notification" : o.register_exit_notification,
-            "remove_quit_notification" :  o.remove_exit_notification
-            }
-          )
+        importer = ProcessImporter(code,
+          {
+          "log" : log,
+          "get_acct" : get_acct,
+          "data_writer" : data_writer,
+          "local_channel" : local_channel,
+          "Sampler" : Sampler,
+          "should_quit" : o.should_exit,
+          "register_quit_notification" : o.register_exit_notification,
+          "remove_quit_notification" :  o.remove_exit_notification
+          }
         )
+        sys.meta_path.append(importer)
+        o.register_function(importer.reload_modules, "reload_code")
+        # Write buffered data as soon as the code is asked to quit, by the
+        # writer threads (this may run in a signal handler)
+        o.register_exit_notification(request_flush_data_writers)
         o.listen()
         try:
             import main
             main.main()
-            q.put({"ok" : True})
+            close_data_writers()
+            res = {"ok" : True}
         except:
-            q.put({"error" : traceback.format_exc()})
-
-    q = _mp.Queue()
-    t = _mp.Process(name=name, target=_new_proc, args=(q,))
+            res = {"error" : traceback.format_exc()}
+            close_data_writers()
+        res["missing_modules"] = importer.missing_modules()
+        res["time"] = time.time()
+        q.send(res)
+
+    r, w = _mp.Pipe(False)
+    t = _mp.Process(name=name, target=_new_proc, args=(w,))
     t.daemon = True
     t.start()
-    return t, q
+    # Only the child should hold the write end
+    w.close()
+    return t, r
 
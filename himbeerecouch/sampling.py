@@ -0,0 +1,171 @@
+import time
+import math
+import array
+import base64
+import operator
+from .datawriter import data_writer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+  Fixed-rate acquisition, uploading aggregated windows instead of single
+  samples.
+"""
+
+def aggregate(values):
+    """
+    Aggregate the samples of one channel
+
+    :param values: samples (array.array or numpy array)
+    :returns: dict - mean, min, max and rms of the values
+    """
+    n = len(values)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        v = values.astype(numpy.float64)
+        return dict(mean=float(v.mean()), min=float(v.min()),
+                    max=float(v.max()), rms=math.sqrt(numpy.dot(v, v)/n))
+    return dict(mean=float(sum(values))/n, min=min(values), max=max(values),
+                rms=math.sqrt(float(sum(map(operator.mul, values, values)))/n))
+
+
+class Sampler(object):
+    """
+    Calls reader at a fixed rate and stores the values in preallocated
+    arrays (numpy arrays if numpy is available).  Every window seconds, one
+    document with the aggregates of the window is written with a
+    :class:`himbeerecouch.datawriter.DataWriter`::
+
+        {
+          "type" : "<doc_type>",
+          "name" : "<name>",
+          "start" : <time of the first sample>,
+          "rate" : <sampling rate (Hz)>,
+          "n" : <number of samples>,
+          "late" : <number of samples taken too late>,
+          "channels" : {
+            "<channel name>" : { "mean" : ..., "min" : ..., "max" : ..., "rms" : ... },
+            ...
+          }
+        }
+
+    With attach_samples, the samples of each channel are added as binary
+    attachments ("<channel name>.bin", machine byte order, typecode given in
+    "typecode").
+
+    :param reader: function returning a value (or a sequence of values, one
+                   per channel)
+    :type reader: callable
+    :param rate: sampling rate (Hz)
+    :type rate: float
+    :param window: length (s) of a window
+    :type window: float
+    :param channels: names of the values returned by reader, None if reader
+                     returns a single value
+    :type channels: list
+    :param name: name written in the documents
+    :type name: str
+    :param doc_type: type of the documents
+    :type doc_type: str
+    :param typecode: array typecode of the stored samples
+    :type typecode: str
+    :param attach_samples: attach the samples to the documents
+    :type attach_samples: bool
+    :param writer: writer of the documents, default :func:`data_writer`
+    :type writer: DataWriter
+    """
+    def __init__(self, reader, rate, window=1.0, channels=None, name=None,
+                 doc_type="data", typecode="d", attach_samples=False,
+                 writer=None):
+        self.reader = reader
+        self.rate = float(rate)
+        self.period = 1.0/self.rate
+        self.size = max(1, int(round(window*self.rate)))
+        self.single = channels is None
+        if self.single: channels = ["value"]
+        self.channels = list(channels)
+        self.name = name
+        self.doc_type = doc_type
+        self.typecode = typecode
+        self.attach_samples = attach_samples
+        self.writer = writer or data_writer()
+        if numpy is not None:
+            self._buffers = [numpy.zeros(self.size, dtype=numpy.dtype(typecode))
+                             for _ in self.channels]
+        else:
+            self._buffers = [array.array(typecode, [0])*self.size
+                             for _ in self.channels]
+        self.windows = 0
+        self.samples = 0
+        self.late = 0
+
+    def _make_doc(self, start, n, late):
+        doc = { "type" : self.doc_type,
+                "start" : start,
+                "rate" : self.rate,
+                "n" : n,
+                "late" : late,
+                "channels" : {} }
+        if self.name is not None: doc["name"] = self.name
+        for ch, buf in zip(self.channels, self._buffers):
+            doc["channels"][ch] = aggregate(buf[:n])
+        if self.attach_samples:
+            doc["typecode"] = self.typecode
+            doc["_attachments"] = dict(
+              ("{}.bin".format(ch), { "content_type" : "application/octet-stream",
+                                      "data" : base64.b64encode(buf[:n].tostring()) })
+              for ch, buf in zip(self.channels, self._buffers))
+        return doc
+
+    def run(self, should_quit=None, duration=None):
+        """
+        Sample until should_quit() returns True or for duration seconds, the
+        last (partial) window is written as well.
+
+        :param should_quit: function, e.g. the exported should_quit
+        :type should_quit: callable
+        :param duration: time (s) to sample, None for no limit
+        :type duration: float
+        """
+        bufs = self._buffers
+        single = self.single
+        reader = self.reader
+        now = time.time()
+        end_time = None
+        if duration is not None: end_time = now + duration
+        next_time = now
+        while True:
+            start = time.time()
+            n = 0
+            late = 0
+            while n < self.size:
+                if should_quit is not None and should_quit(): break
+                now = time.time()
+                if end_time is not None and now >= end_time: break
+                if next_time > now:
+                    time.sleep(next_time - now)
+                elif now - next_time > self.period:
+                    # Too slow, don't try to catch up on missed samples
+                    late += 1
+                    next_time = now
+                v = reader()
+                if single:
+                    bufs[0][n] = v
+                else:
+                    for buf, x in zip(bufs, v): buf[n] = x
+                n += 1
+                next_time += self.period
+            if n > 0:
+                self.writer.write(self._make_doc(start, n, late))
+                self.windows += 1
+                self.samples += n
+                self.late += late
+            if n < self.size: return
+
+    def stats(self):
+        """
+        :returns: dict - number of windows and samples written and number of
+                  late samples
+        """
+        return dict(windows=self.windows, samples=self.samples, late=self.late)
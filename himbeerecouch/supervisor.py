@@ -0,0 +1,248 @@
+import os
+import time
+import errno
+import select
+from .log import log
+
+
+class ChildRecord(object):
+    """
+    Book-keeping for a supervised child process
+
+    :param name: name of child process
+    :type name: str
+    :param proc: child process
+    :type proc: multiprocessing.Process
+    :param conn: read end of the result pipe of the child
+    :type conn: multiprocessing.Connection
+    :param limits: resource limits of the child
+    :type limits: dict
+    """
+    def __init__(self, name, proc, conn, limits=None):
+        self.name = name
+        self.proc = proc
+        self.conn = conn
+        self.limits = limits or {}
+        self.breaches = {}
+        self.start_time = time.time()
+        self.startup_time = None
+        self.registration_failed = False
+        self.telemetry = None
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+
+class ChildSupervisor(object):
+    """
+    Supervises child processes (started by
+    :func:`himbeerecouch.rpc.start_new_process`).
+
+    Instead of polling every child in turn, :meth:`wait` blocks on the result
+    pipes of all children together with a wakeup pipe.  A child closing its
+    end of the result pipe (i.e. exiting, also when crashing) makes its pipe
+    readable, so the exit of a child is noticed immediately, independent of
+    the number of children.
+    """
+    def __init__(self):
+        self._children = {}
+        self._names = {}
+        self._restarts = {}
+        self._exit_latency = {}
+        self._startup_time = {}
+        self._breaches = {}
+        self._wake_r, self._wake_w = os.pipe()
+
+    def __len__(self):
+        return len(self._children)
+
+    def __contains__(self, anid):
+        return anid in self._children
+
+    def ids(self):
+        return self._children.keys()
+
+    def get(self, anid):
+        return self._children[anid]
+
+    def add(self, anid, name, proc, conn, limits=None):
+        """
+        Add a child process to be supervised.  Adding an id that was already
+        supervised before counts as a restart.
+        """
+        if anid in self._restarts:
+            self._restarts[anid] += 1
+        else:
+            self._restarts[anid] = 0
+        self._names[anid] = name
+        self._children[anid] = ChildRecord(name, proc, conn, limits)
+        self._breaches.setdefault(anid, {})
+
+    def remove(self, anid):
+        """
+        Stop supervising a child process
+
+        :returns: ChildRecord
+        """
+        rec = self._children.pop(anid)
+        try:
+            rec.conn.close()
+        except: pass
+        return rec
+
+    def wake(self):
+        """
+        Wake up a :meth:`wait` call, may be called from any thread.
+        """
+        try:
+            os.write(self._wake_w, "x")
+        except OSError: pass
+
+    def wait(self, timeout=None):
+        """
+        Wait until at least one child exits, :meth:`wake` is called or timeout
+        (s) passes.
+
+        :returns: list of (id, ChildRecord, result) of the children that exited.
+                  result is the dictionary sent by the child, see
+                  :func:`himbeerecouch.rpc.start_new_process`.
+        """
+        fds = dict((rec.conn.fileno(), anid) for anid, rec in self._children.items())
+        try:
+            ready, _, _ = select.select(fds.keys() + [self._wake_r], [], [], timeout)
+        except select.error as e:
+            # Interrupted by a signal
+            if e.args[0] != errno.EINTR: raise
+            return []
+
+        if self._wake_r in ready:
+            os.read(self._wake_r, 4096)
+
+        finished = []
+        now = time.time()
+        for fd in ready:
+            if fd not in fds: continue
+            anid = fds[fd]
+            rec = self._children[anid]
+            try:
+                res = rec.conn.recv()
+            except (EOFError, IOError):
+                rec.proc.join()
+                res = { "error" : "Process exited ({}) without result".format(rec.proc.exitcode) }
+            rec.proc.join()
+            if "time" in res:
+                self._exit_latency[anid] = now - res["time"]
+                log("Process ({}) exited, seen after {:.1f} ms".format(rec.name,
+                  1000*self._exit_latency[anid]))
+            self.remove(anid)
+            finished.append((anid, rec, res))
+        return finished
+
+    def check_registration(self, registration_time, timeout):
+        """
+        Check which children have registered with the RPC server, recording
+        their startup time (from fork to registration).
+
+        :param registration_time: function returning the time a pid
+                                  registered or None (see
+                                  :meth:`himbeerecouch.rpc.RPCServer.registration_time`)
+        :type registration_time: function
+        :param timeout: time (s) a child may take to register
+        :type timeout: float
+        :returns: list of (id, ChildRecord) of children that did not register
+                  within timeout
+        """
+        overdue = []
+        now = time.time()
+        for anid, rec in self._children.items():
+            if rec.startup_time is not None or rec.registration_failed: continue
+            reg_time = registration_time(rec.pid)
+            if reg_time is not None:
+                rec.startup_time = reg_time - rec.start_time
+                self._startup_time[anid] = rec.startup_time
+                log("Process ({}) registered after {:.1f} ms".format(rec.name,
+                  1000*rec.startup_time))
+            elif now - rec.start_time > timeout:
+                rec.registration_failed = True
+                overdue.append((anid, rec))
+        return overdue
+
+    def sample_telemetry(self, sampler):
+        """
+        Sample the resource usage of all children.
+
+        :param sampler: sampler
+        :type sampler: :class:`himbeerecouch.telemetry.TelemetrySampler`
+        :returns: list of samples (dicts, including "name" and "time")
+        """
+        samples = []
+        now = time.time()
+        for anid, rec in self._children.items():
+            sample = sampler.sample(rec.pid)
+            if sample is None: continue
+            if "max_open_files" in rec.limits:
+                try:
+                    sample["open_files"] = len(os.listdir("/proc/{}/fd".format(rec.pid)))
+                except OSError: pass
+            sample["uptime"] = round(now - rec.start_time, 1)
+            sample["restarts"] = self._restarts[anid]
+            rec.telemetry = sample
+            samples.append(dict(sample, name=rec.name, time=now))
+        return samples
+
+    def check_limits(self):
+        """
+        Check the last telemetry sample (see :meth:`sample_telemetry`) of each
+        child against its limits "max_rss_mb" and "max_open_files".
+
+        :returns: list of (id, ChildRecord, limit name, value) for every
+                  limit that has been exceeded
+        """
+        breaches = []
+        for anid, rec in self._children.items():
+            if rec.telemetry is None: continue
+            for limit, key in [("max_rss_mb", "rss_mb"), ("max_open_files", "open_files")]:
+                if limit not in rec.limits or key not in rec.telemetry: continue
+                value = rec.telemetry[key]
+                if value < rec.limits[limit]: continue
+                rec.breaches[limit] = rec.breaches.get(limit, 0) + 1
+                # Reported over all restarts
+                total = self._breaches[anid]
+                total[limit] = total.get(limit, 0) + 1
+                breaches.append((anid, rec, limit, value))
+        return breaches
+
+    def stats(self):
+        """
+        Return statistics of all children supervised so far:
+
+            {
+              "name" : { "restarts" : int,
+                         "exit_latency" : float (s),
+                         "startup_time" : float (s) },
+              ...
+            }
+
+        exit_latency is the time between a child sending its result and the
+        supervisor noticing, and is only available after a child has exited.
+        startup_time is the time from forking a child until it registered
+        with the RPC server.  For running children, the last sample of
+        :meth:`sample_telemetry` is included as "telemetry" and the number
+        of times each limit was exceeded as "limit_breaches".
+        """
+        ret = {}
+        for anid, name in self._names.items():
+            ret[name] = { "restarts" : self._restarts[anid],
+                          "exit_latency" : self._exit_latency.get(anid),
+                          "startup_time" : self._startup_time.get(anid),
+                          "limit_breaches" : self._breaches.get(anid, {}) }
+            if anid in self._children:
+                ret[name]["telemetry"] = self._children[anid].telemetry
+        return ret
+
+    def close(self):
+        for anid in self.ids():
+            self.remove(anid)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
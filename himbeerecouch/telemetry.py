@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+import logging
+from .database import get_database
+from .util import getmacid
+
+_clock_ticks = os.sysconf("SC_CLK_TCK")
+_page_size = os.sysconf("SC_PAGE_SIZE")
+
+def read_proc_stat(pid):
+    """
+    Read resource usage of a process from /proc/<pid>/stat
+
+    :param pid: process id
+    :type pid: int
+    :returns: dict - with cpu_time (s), rss (bytes) and threads
+    """
+    with open("/proc/{}/stat".format(pid)) as f:
+        data = f.read()
+    # The name of the process (2nd field) may contain spaces, so start after it
+    fields = data[data.rindex(")")+2:].split()
+    return dict(cpu_time=float(int(fields[11]) + int(fields[12]))/_clock_ticks,
+                threads=int(fields[17]),
+                rss=int(fields[21])*_page_size)
+
+
+class TelemetrySampler(object):
+    """
+    Samples resource usage of processes.  CPU usage is calculated
+    incrementally from the CPU time used since the previous sample of the
+    same process.
+    """
+    def __init__(self):
+        self._last = {}
+
+    def sample(self, pid):
+        """
+        :returns: dict - cpu (% since last sample, None on the first sample),
+                  cpu_time (s), rss_mb and threads, or None if the process
+                  doesn't exist
+        """
+        try:
+            st = read_proc_stat(pid)
+        except (IOError, ValueError, IndexError):
+            self.forget(pid)
+            return None
+        now = time.time()
+        cpu = None
+        if pid in self._last:
+            last_time, last_cpu = self._last[pid]
+            if now > last_time:
+                cpu = round(100*(st["cpu_time"] - last_cpu)/(now - last_time), 1)
+        self._last[pid] = (now, st["cpu_time"])
+        return dict(cpu=cpu,
+                    cpu_time=round(st["cpu_time"], 2),
+                    rss_mb=round(float(st["rss"])/2**20, 1),
+                    threads=st["threads"])
+
+    def forget(self, pid):
+        self._last.pop(pid, None)
+
+
+class TelemetrySeries(object):
+    """
+    Collects telemetry samples and writes them to the database in batches,
+    one document (type "<macid>_telemetry") per batch::
+
+        {
+          "type" : "<macid>_telemetry",
+          "samples" : [ { "time" : ..., "name" : ..., "cpu" : ..., ... }, ... ]
+        }
+
+    :param batch_size: number of samples written in one document
+    :type batch_size: int
+    :param max_samples: maximum number of samples kept when writing fails
+    :type max_samples: int
+    """
+    def __init__(self, batch_size=100, max_samples=5000):
+        self._batch_size = batch_size
+        self._max_samples = max_samples
+        self._samples = []
+        self._lock = threading.Lock()
+        self._writing = False
+
+    def add(self, samples):
+        """
+        Add samples (list of dicts), writes to the database (in a background
+        thread) when a batch is full
+        """
+        with self._lock:
+            self._samples.extend(samples)
+            del self._samples[:-self._max_samples]
+            if len(self._samples) < self._batch_size or self._writing: return
+            self._writing = True
+        t = threading.Thread(target=self._write)
+        t.daemon = True
+        t.start()
+
+    def _write(self):
+        with self._lock:
+            batch = self._samples[:self._batch_size]
+        try:
+            doc = { "type" : "{}_telemetry".format(getmacid()), "samples" : batch }
+            get_database().post("_bulk_docs", params=dict(docs=[doc]))
+            with self._lock:
+                del self._samples[:len(batch)]
+        except:
+            logging.exception("Error writing telemetry")
+        finally:
+            with self._lock:
+                self._writing = False
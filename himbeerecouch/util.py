@@ -1,5 +1,8 @@
 import hashlib
 import threading
+import json
+import os
+import random
 import time
 import sys
 import traceback
@@ -124,3 +127,84 @@ def stack_trace(ignore_from=None):
                 code.append("     {}".format(line.strip()))
 
     return code
+
+def read_json_file(path, default=None):
+    """
+      Read json from a file, returning default if the file doesn't exist or
+      can't be parsed.
+
+      :param path: path to file
+      :type path: str
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def write_json_file(path, obj):
+    """
+      Atomically write obj as json to a file (i.e. writes to a temporary file
+      and renames it), so that a crash never leaves a partially written file.
+
+      :param path: path to file
+      :type path: str
+      :param obj: json-serializable object
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.rename(tmp_path, path)
+
+def backoff_delay(attempt, base=0.5, cap=60.0):
+    """
+      Return a delay (in seconds) for an exponential backoff with jitter.  The
+      delay is chosen randomly between 0 and min(cap, base*2**attempt) (i.e.
+      "full jitter"), so that many clients reconnecting at the same time do
+      not all hit the server together.
+
+      :param attempt: number of failed attempts so far
+      :type attempt: int
+      :rtype: float
+    """
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+
+def set_cpu_affinity(cpus, pid=0):
+    """
+      Set the CPUs a process may run on
+
+      :param cpus: list of cpu numbers
+      :type cpus: list
+      :param pid: process id, 0 is the current process
+      :type pid: int
+    """
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    mask = 0
+    for c in cpus:
+        mask |= 1 << int(c)
+    cpu_set = ctypes.c_ulong(mask)
+    if libc.sched_setaffinity(pid, ctypes.sizeof(cpu_set), ctypes.byref(cpu_set)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+def apply_limits(limits):
+    """
+      Apply resource limits to the current process
+
+      :param limits: dictionary, may include "cpu_affinity" (list of cpus),
+                     "nice" (niceness) and "max_open_files".  "max_rss_mb" is
+                     not enforced by the kernel, but by the supervisor.
+      :type limits: dict
+    """
+    import resource
+    if "cpu_affinity" in limits:
+        set_cpu_affinity(limits["cpu_affinity"])
+    if "nice" in limits:
+        os.nice(int(limits["nice"]) - os.nice(0))
+    if "max_open_files" in limits:
+        n = int(limits["max_open_files"])
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY: n = min(n, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n, hard))